@@ -0,0 +1,92 @@
+"""
+Measures the cold start of google_services and pdf_protecting.
+
+Every measurement runs in a new Python process, like a new Cloud Function instance:
+    - import: the time to import the module
+    - eager import: the same, with the libraries that module used to import up front imported first, see HEAVY_MODULES
+    - first service: the time to build the first Drive service, which imports the libraries left out of the import
+      and loads the discovery document
+    - second service: the time to build another one from the cached discovery document
+
+Usage:
+    python benchmarks/cold_start.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The heavy libraries each module used to import at load time, and now imports when they are first needed
+HEAVY_MODULES = {
+    "google_services": ["httplib2", "google_auth_httplib2", "google.oauth2.service_account", "googleapiclient.discovery"],
+    "pdf_protecting": ["pypdf", "httplib2", "google.oauth2.service_account", "google.oauth2.credentials", "googleapiclient.discovery"],
+}
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+if {eager}:
+    for name in {heavy!r}:
+        __import__(name)
+import {module}
+imported = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+
+from google.auth.credentials import AnonymousCredentials
+start = time.perf_counter()
+{module}.create_service('drive', 'v3', AnonymousCredentials())
+first_service = time.perf_counter() - start
+start = time.perf_counter()
+{module}.create_service('drive', 'v3', AnonymousCredentials())
+second_service = time.perf_counter() - start
+
+print(json.dumps({{"import": imported, "first service": first_service, "second service": second_service, "loaded": loaded}}))
+"""
+
+def measure(module: str, runs: int) -> dict:
+    """
+    Measures the cold start of a module in new processes.
+
+    Args:
+        module (str): The name of the module, a key of HEAVY_MODULES
+        runs (int): The number of processes to measure
+
+    Returns:
+        dict: The median seconds by measurement, and the heavy libraries that were loaded by the import
+    """
+    def run(eager):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT.format(module=module, heavy=HEAVY_MODULES[module], eager=eager)],
+            cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    results = [run(False) for _ in range(runs)]
+    return {
+        "import": statistics.median(result["import"] for result in results),
+        "eager import": statistics.median(run(True)["import"] for _ in range(runs)),
+        "first service": statistics.median(result["first service"] for result in results),
+        "second service": statistics.median(result["second service"] for result in results),
+        "loaded": results[0]["loaded"]
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="The number of processes per module")
+    parser.add_argument("modules", nargs="*", default=["google_services", "pdf_protecting"])
+    args = parser.parse_args()
+
+    for module in args.modules:
+        summary = measure(module, args.runs)
+        print(f"{module} (median of {args.runs} runs)")
+        for key, seconds in summary.items():
+            if key != "loaded":
+                print(f"  {key:<15} {seconds * 1000:8.1f} ms")
+        print(f"  loaded on import: {', '.join(summary['loaded']) or 'none of ' + ', '.join(HEAVY_MODULES[module])}")
+
+if __name__ == "__main__":
+    main()
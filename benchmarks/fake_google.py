@@ -0,0 +1,511 @@
+"""
+A local stand-in for the Drive v3 and Sheets v4 APIs, for benchmarking google_services without using any quota.
+
+It keeps files, permissions and spreadsheets in memory and implements the endpoints the helpers use:
+    - Drive files: list (with the queries the helpers send), get, media download, create, update of parents
+    - Drive permissions: list, create, update, delete
+    - Drive batch requests and changes.getStartPageToken
+    - Sheets: spreadsheets.get, values.get and values.batchGet
+Pagination and the fields parameter work like the real APIs. Every call can be slowed down by a fixed latency,
+and a share of the calls can be answered with a 429, to see how the helpers hold up.
+
+Usage:
+    python benchmarks/fake_google.py --port 8080 --latency 0.05 --error-rate 0.01
+
+    server, base_url = start_fake_google(latency=0.05)
+    drive_service = create_fake_service('drive', 'v3', base_url)
+
+    # In a child process, so the fake's memory and CPU time aren't measured along with the helpers
+    fake = FakeGoogleProcess(latency=0.05)
+    drive_service = create_fake_service('drive', 'v3', fake.base_url)
+"""
+from __future__ import annotations
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import google_services
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SPREADSHEET_MIME_TYPE = "application/vnd.google-apps.spreadsheet"
+
+class FakeGoogle:
+    """
+    The in-memory state of the fake APIs and the handling of their calls.
+
+    Attributes:
+        latency (float): The seconds every HTTP request waits before it is answered
+        error_rate (float): The share of calls answered with a 429, between 0 and 1
+        retry_after (float): The Retry-After sent with the 429s, not sent if 0
+        calls (int): The number of API calls handled, every call in a batch counts
+        requests (int): The number of HTTP requests handled
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, retry_after: float = 0, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        # Reentrant, as the call handlers run with it held and use the add_ methods
+        self.lock = threading.RLock()
+        self.files = {}
+        self.contents = {}
+        self.permissions = {}
+        self.spreadsheets = {}
+        self.calls = 0
+        self.requests = 0
+
+    def add_file(self, name: str, parent_id: str = None, mime_type: str = "application/pdf", content: bytes = b"", file_id: str = None) -> dict:
+        """Adds a file or folder and returns it."""
+        file_id = file_id or uuid.uuid4().hex
+        with self.lock:
+            self.files[file_id] = {
+                "kind": "drive#file",
+                "id": file_id,
+                "name": name,
+                "mimeType": mime_type,
+                "parents": [parent_id] if parent_id else [],
+                "modifiedTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                "createdTime": time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime()),
+                "size": str(len(content)),
+                "permissionIds": [],
+                "webViewLink": f"https://drive.google.com/file/d/{file_id}/view"
+            }
+            self.contents[file_id] = content
+            self.permissions[file_id] = []
+            return self.files[file_id]
+
+    def add_permission(self, file_id: str, permission: dict) -> dict:
+        """Adds a permission to a file and returns it."""
+        with self.lock:
+            permission = {"kind": "drive#permission", "id": uuid.uuid4().hex[:20], **permission}
+            self.permissions[file_id].append(permission)
+            self.files[file_id]["permissionIds"].append(permission["id"])
+            return permission
+
+    def add_spreadsheet(self, title: str, tabs: dict, parent_id: str = None) -> dict:
+        """Adds a spreadsheet with the rows of every tab, by tab title, and returns its file. Tabs with None rows are charts."""
+        file = self.add_file(title, parent_id, SPREADSHEET_MIME_TYPE)
+        with self.lock:
+            self.spreadsheets[file["id"]] = {
+                title: None if rows is None else [list(map(str, row)) for row in rows] for title, rows in tabs.items()
+            }
+        return file
+
+    def handle(self, method: str, url: str, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        """Answers an HTTP request, returning its status, headers and body."""
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = urlparse(url).path
+        if path.startswith("/batch/"):
+            return self.handle_batch(headers, body)
+
+        status, response = self.handle_call(method, url, body)
+        if isinstance(response, bytes):
+            return status, {"Content-Type": "application/octet-stream"}, response
+        response_headers = {"Content-Type": "application/json; charset=UTF-8"}
+        if status == 429 and self.retry_after:
+            response_headers["Retry-After"] = str(self.retry_after)
+        return status, response_headers, json.dumps(response).encode()
+
+    def handle_batch(self, headers: dict, body: bytes) -> tuple[int, dict, bytes]:
+        """Answers a batch request by handling each of its calls, see handle_call."""
+        content_type = headers.get("Content-Type") or headers.get("content-type")
+        message = BytesParser(policy=policy.HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+
+        boundary = uuid.uuid4().hex
+        parts = []
+        for part in message.iter_parts():
+            content_id = (part["Content-ID"] or "").strip("<>")
+            request = part.get_payload()
+            request = request.encode() if isinstance(request, str) else request
+            head, _, call_body = request.replace(b"\r\n", b"\n").partition(b"\n\n")
+            method, call_url = head.split(b"\n")[0].decode().split(" ")[:2]
+
+            status, response = self.handle_call(method, call_url, call_body)
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(response)}\r\n"
+            )
+        return 200, {"Content-Type": f"multipart/mixed; boundary={boundary}"}, ("".join(parts) + f"--{boundary}--").encode()
+
+    def handle_call(self, method: str, url: str, body: bytes) -> tuple[int, dict | bytes]:
+        """Answers a single API call, returning its status and JSON response, or the bytes of a download."""
+        with self.lock:
+            self.calls += 1
+            rate_limited = self.error_rate and self.random.random() < self.error_rate
+        if rate_limited:
+            return 429, get_error(429, "Rate limit exceeded", "rateLimitExceeded")
+
+        parsed = urlparse(url)
+        path = unquote(parsed.path)
+        query = {key: values[0] if len(values) == 1 else values for key, values in parse_qs(parsed.query).items()}
+        data = json.loads(body) if body and body.strip() else {}
+
+        routes = [
+            ("GET", r"/drive/v3/files", self.list_files),
+            ("POST", r"/drive/v3/files", self.create_file),
+            ("GET", r"/drive/v3/changes/startPageToken", lambda query, data: (200, {"startPageToken": "1"})),
+            ("GET", r"/drive/v3/changes", lambda query, data: (200, {"changes": [], "newStartPageToken": "1"})),
+            ("GET", r"/drive/v3/files/([^/]+)", self.get_file),
+            ("PATCH", r"/drive/v3/files/([^/]+)", self.update_file),
+            ("GET", r"/drive/v3/files/([^/]+)/permissions", self.list_permissions),
+            ("POST", r"/drive/v3/files/([^/]+)/permissions", self.create_permission),
+            ("PATCH", r"/drive/v3/files/([^/]+)/permissions/([^/]+)", self.update_permission),
+            ("DELETE", r"/drive/v3/files/([^/]+)/permissions/([^/]+)", self.delete_permission),
+            ("GET", r"/v4/spreadsheets/([^/]+)", self.get_spreadsheet),
+            ("GET", r"/v4/spreadsheets/([^/]+)/values:batchGet", self.batch_get_values),
+            ("GET", r"/v4/spreadsheets/([^/]+)/values/(.+)", self.get_values),
+        ]
+        for route_method, pattern, handler in routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                with self.lock:
+                    return handler(*match.groups(), query=query, data=data)
+        return 404, get_error(404, f"Not found: {method} {path}")
+
+    def list_files(self, query: dict, data: dict) -> tuple[int, dict]:
+        q = query.get("q", "")
+        parent = re.search(r"'([^']+)' in parents", q)
+        mime_type = re.search(r"mimeType\s*=\s*'([^']+)'", q)
+        name = re.search(r"name\s*=\s*'((?:[^'\\]|\\.)*)'", q)
+        name = re.sub(r"\\(.)", r"\1", name.group(1)) if name else None
+
+        files = [
+            file for file in self.files.values()
+            if (not parent or parent.group(1) in file["parents"])
+            and (not mime_type or file["mimeType"] == mime_type.group(1))
+            and (name is None or file["name"] == name)
+        ]
+        return 200, get_page(files, "files", query, default_page_size=100, max_page_size=1000)
+
+    def create_file(self, query: dict, data: dict) -> tuple[int, dict]:
+        file = self.add_file(data.get("name", "Untitled"), (data.get("parents") or [None])[0], data.get("mimeType", "application/octet-stream"))
+        return 200, project(file, query.get("fields"), "id,name,mimeType,kind")
+
+    def get_file(self, file_id: str, query: dict, data: dict) -> tuple[int, dict | bytes]:
+        if file_id not in self.files:
+            return 404, get_error(404, f"File not found: {file_id}.", "notFound")
+        if query.get("alt") == "media":
+            return 200, self.contents[file_id]
+        return 200, project(self.files[file_id], query.get("fields"), "id,name,mimeType,kind")
+
+    def update_file(self, file_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        if file_id not in self.files:
+            return 404, get_error(404, f"File not found: {file_id}.", "notFound")
+        file = self.files[file_id]
+        remove = set(filter(None, query.get("removeParents", "").split(",")))
+        add = [parent for parent in query.get("addParents", "").split(",") if parent]
+        file["parents"] = [parent for parent in file["parents"] if parent not in remove] + [parent for parent in add if parent not in file["parents"]]
+        file.update({key: value for key, value in data.items() if key in ("name", "description")})
+        return 200, project(file, query.get("fields"), "id,name,mimeType,kind")
+
+    def list_permissions(self, file_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        if file_id not in self.permissions:
+            return 404, get_error(404, f"File not found: {file_id}.", "notFound")
+        return 200, get_page(self.permissions[file_id], "permissions", query, default_page_size=100, max_page_size=100)
+
+    def create_permission(self, file_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        if file_id not in self.permissions:
+            return 404, get_error(404, f"File not found: {file_id}.", "notFound")
+        permission = {"kind": "drive#permission", "id": uuid.uuid4().hex[:20], **data}
+        self.permissions[file_id].append(permission)
+        self.files[file_id]["permissionIds"].append(permission["id"])
+        return 200, project(permission, query.get("fields"), "id,type,role,kind")
+
+    def update_permission(self, file_id: str, permission_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        for permission in self.permissions.get(file_id, []):
+            if permission["id"] == permission_id:
+                permission.update(data)
+                return 200, project(permission, query.get("fields"), "id,type,role,kind")
+        return 404, get_error(404, f"Permission not found: {permission_id}.", "notFound")
+
+    def delete_permission(self, file_id: str, permission_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        permissions = self.permissions.get(file_id, [])
+        for permission in permissions:
+            if permission["id"] == permission_id:
+                permissions.remove(permission)
+                self.files[file_id]["permissionIds"].remove(permission_id)
+                return 204, {}
+        return 404, get_error(404, f"Permission not found: {permission_id}.", "notFound")
+
+    def get_spreadsheet(self, ss_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        if ss_id not in self.spreadsheets:
+            return 404, get_error(404, "Requested entity was not found.", "notFound")
+        sheets = []
+        for index, (title, rows) in enumerate(self.spreadsheets[ss_id].items()):
+            properties = {"sheetId": index, "title": title, "index": index, "sheetType": "GRID" if rows is not None else "OBJECT"}
+            # Like the real API, chart tabs have no grid
+            if rows is not None:
+                properties["gridProperties"] = {"rowCount": max(1000, len(rows)), "columnCount": max(26, max((len(row) for row in rows), default=0))}
+            sheets.append({"properties": properties})
+        return 200, {"spreadsheetId": ss_id, "properties": {"title": self.files[ss_id]["name"]}, "sheets": sheets}
+
+    def get_values(self, ss_id: str, range_name: str, query: dict, data: dict) -> tuple[int, dict]:
+        if ss_id not in self.spreadsheets:
+            return 404, get_error(404, "Requested entity was not found.", "notFound")
+        return get_value_range(self.spreadsheets[ss_id], range_name)
+
+    def batch_get_values(self, ss_id: str, query: dict, data: dict) -> tuple[int, dict]:
+        if ss_id not in self.spreadsheets:
+            return 404, get_error(404, "Requested entity was not found.", "notFound")
+        ranges = query.get("ranges", [])
+        value_ranges = []
+        for range_name in [ranges] if isinstance(ranges, str) else ranges:
+            status, value_range = get_value_range(self.spreadsheets[ss_id], range_name)
+            if status != 200:
+                return status, value_range
+            value_ranges.append(value_range)
+        return 200, {"spreadsheetId": ss_id, "valueRanges": value_ranges}
+
+def get_error(status: int, message: str, reason: str = None) -> dict:
+    """Returns the body of an error response, like the Google APIs send."""
+    error = {"code": status, "message": message}
+    if reason:
+        error["errors"] = [{"message": message, "domain": "usageLimits" if status == 429 else "global", "reason": reason}]
+    return {"error": error}
+
+def get_page(items: list[dict], collection: str, query: dict, default_page_size: int, max_page_size: int) -> dict:
+    """Returns a page of items, the page token is the position of the page's first item."""
+    start = int(query.get("pageToken") or 0)
+    page_size = min(int(query.get("pageSize") or default_page_size), max_page_size)
+    page = {collection: [project(item, get_item_fields(query.get("fields"), collection)) for item in items[start:start + page_size]]}
+    if start + page_size < len(items):
+        page["nextPageToken"] = str(start + page_size)
+    return page
+
+def get_item_fields(fields: str, collection: str) -> str:
+    """Returns the fields of the items in a fields mask, e.g. 'id,name' for 'nextPageToken,files(id,name)'."""
+    if not fields:
+        return None
+    match = re.search(re.escape(collection) + r"\((.*)\)", fields)
+    return match.group(1) if match else "*"
+
+def project(item: dict, fields: str, default: str = None) -> dict:
+    """Returns only the top level fields of an item that are asked for, e.g. 'id,name,permissionDetails(role)'."""
+    fields = fields or default
+    if not fields or fields.strip() == "*":
+        return copy.deepcopy(item)
+    names = set(name.strip() for name in re.sub(r"\([^()]*\)", "", fields).split(","))
+    return {key: copy.deepcopy(value) for key, value in item.items() if key in names}
+
+def get_value_range(tabs: dict, range_name: str) -> tuple[int, dict]:
+    """Returns the values of an A1 range, e.g. 'Tab', "'My Tab'!A1:B400" or 'Tab!1:1000'."""
+    title, cells = google_services.split_range(range_name)
+    title = title[1:-1].replace("''", "'") if title.startswith("'") else title
+    if tabs.get(title) is None:
+        return 400, get_error(400, f"Unable to parse range: {range_name}", "badRequest")
+    rows = tabs[title]
+
+    match = re.fullmatch(r"([A-Za-z]*)(\d*):([A-Za-z]*)(\d*)", cells if ":" in cells else f"{cells}:{cells}")
+    start_column, start_row, end_column, end_row = match.groups() if match else ("", "", "", "")
+    first_row = int(start_row) - 1 if start_row else 0
+    last_row = int(end_row) if end_row else len(rows)
+    first_column = get_column_index(start_column) if start_column else 0
+    last_column = get_column_index(end_column) + 1 if end_column else None
+
+    values = [row[first_column:last_column] for row in rows[first_row:last_row]]
+    # Trailing blank rows are left out, like the real API does
+    while values and not any(values[-1]):
+        values.pop()
+    value_range = {"range": range_name, "majorDimension": "ROWS"}
+    if values:
+        value_range["values"] = values
+    return 200, value_range
+
+def get_column_index(column: str) -> int:
+    """Returns the position of a column, e.g. 0 for 'A' and 26 for 'AA'."""
+    index = 0
+    for letter in column.upper():
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+class FakeGoogleHandler(BaseHTTPRequestHandler):
+    """Passes the HTTP requests of the server to its FakeGoogle."""
+
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, response = self.server.fake.handle(self.command, self.path, dict(self.headers), body)
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fake_google(port: int = 0, latency: float = 0, error_rate: float = 0, retry_after: float = 0) -> tuple[ThreadingHTTPServer, str]:
+    """
+    Starts the fake APIs on a background thread.
+
+    Args:
+        port (int): The port to listen on, a free one if 0
+        latency (float): The seconds every HTTP request waits before it is answered
+        error_rate (float): The share of calls answered with a 429, between 0 and 1
+        retry_after (float): The Retry-After sent with the 429s, not sent if 0
+
+    Returns:
+        tuple[ThreadingHTTPServer, str]: The server, with its state as server.fake, and its base url
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), FakeGoogleHandler)
+    server.daemon_threads = True
+    server.fake = FakeGoogle(latency, error_rate, retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+class FakeGoogleProcess:
+    """
+    Runs the fake APIs in a child process, so the memory and CPU time they use don't count towards
+    the helpers being measured in this one.
+
+    The state of the fake APIs lives in the child, it is changed with call.
+
+    Attributes:
+        base_url (str): The base url of the fake APIs
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0, retry_after: float = 0):
+        # Not forked, as the parent may have threads and tracemalloc running
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve_fake_google, args=(child_connection, latency, error_rate, retry_after), daemon=True)
+        self.process.start()
+        # Only the child holds its end, so the pipe breaks instead of hanging if the child dies
+        child_connection.close()
+        self.base_url = self.connection.recv()
+
+    def call(self, function, *args):
+        """
+        Runs function(fake, *args) in the child process, with its FakeGoogle, and returns the result.
+        The function has to be defined at the top level of a module, so it can be sent to the child.
+        """
+        self.connection.send(("call", function, args))
+        return self.receive()
+
+    def reset(self):
+        """Replaces the state of the fake APIs with an empty FakeGoogle, with the same latency and error rate."""
+        self.connection.send(("reset", None, ()))
+        return self.receive()
+
+    def receive(self):
+        error, result = self.connection.recv()
+        if error:
+            raise Exception(f"The fake APIs failed: {error}")
+        return result
+
+    def close(self):
+        """Stops the fake APIs and their process."""
+        self.connection.send(None)
+        self.process.join()
+        self.connection.close()
+
+    def __enter__(self) -> FakeGoogleProcess:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def serve_fake_google(connection, latency: float, error_rate: float, retry_after: float):
+    """
+    Runs the fake APIs and carries out the messages of FakeGoogleProcess until it is closed.
+
+    Args:
+        connection: The child's end of the pipe to the FakeGoogleProcess
+        latency (float): The seconds every HTTP request waits before it is answered
+        error_rate (float): The share of calls answered with a 429, between 0 and 1
+        retry_after (float): The Retry-After sent with the 429s, not sent if 0
+    """
+    server, base_url = start_fake_google(latency=latency, error_rate=error_rate, retry_after=retry_after)
+    connection.send(base_url)
+    try:
+        while True:
+            message = connection.recv()
+            if message is None:
+                break
+            command, function, args = message
+            try:
+                if command == "reset":
+                    server.fake = FakeGoogle(latency, error_rate, retry_after)
+                    result = None
+                else:
+                    result = function(server.fake, *args)
+                connection.send((None, result))
+            except Exception as e:
+                connection.send((repr(e), None))
+    finally:
+        server.shutdown()
+        connection.close()
+
+def get_call_count(fake: FakeGoogle) -> int:
+    """Returns the number of API calls handled so far, for FakeGoogleProcess.call."""
+    return fake.calls
+
+def create_fake_service(api_name: str, api_version: str, base_url: str):
+    """
+    Returns a service of google_services that sends its calls to the fake APIs instead of Google.
+
+    Args:
+        api_name (str): The name of the API, 'drive' or 'sheets'
+        api_version (str): The version of the API, 'v3' or 'v4'
+        base_url (str): The base url of the fake APIs, see start_fake_google
+
+    Returns:
+        Resource: The service
+    """
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+
+    document = copy.deepcopy(google_services.get_discovery_document(api_name, api_version))
+    document["rootUrl"] = base_url
+    document["mtlsRootUrl"] = base_url
+    document["baseUrl"] = base_url + document["servicePath"]
+    return build_from_document(document, http=httplib2.Http())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0, help="Seconds every request waits before it is answered")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=0, help="Retry-After sent with the 429s")
+    args = parser.parse_args()
+
+    server, base_url = start_fake_google(args.port, args.latency, args.error_rate, args.retry_after)
+    folder = server.fake.add_file("Folder", mime_type=FOLDER_MIME_TYPE, file_id="folder")
+    for i in range(1000):
+        server.fake.add_file(f"File {i}.pdf", folder["id"])
+    print(f"Fake Drive and Sheets APIs listening on {base_url}, with 1000 files in the folder 'folder'")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+"""
+Benchmarks the google_services helpers against the fake APIs of fake_google, without using any quota.
+
+For every helper it reports:
+    - calls/s: the API calls handled per second, every call in a batch counts
+    - requests: the HTTP requests sent, and their p50, p95 and p99 latency
+    - peak memory: the most memory allocated by Python while the helper ran, measured with tracemalloc
+      in a second run, as tracing slows the helpers down. The fake APIs run in a child process, so only
+      the memory of the helper is counted
+
+Every run starts from an empty fake, so the results don't depend on the benchmarks that ran before.
+
+The rate limiters of google_services only slow the helpers down if the GOOGLE_<API>_RATE_LIMIT
+environment variables are set.
+
+Usage:
+    python benchmarks/google_services_benchmarks.py --latency 0.02 --error-rate 0.01
+    python benchmarks/google_services_benchmarks.py --save baseline.json
+    python benchmarks/google_services_benchmarks.py --compare baseline.json --tolerance 0.2
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from contextlib import redirect_stdout
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httplib2
+import google_services
+import fake_google
+
+class RequestTimer:
+    """Records the latency of every HTTP request sent through httplib2 while it is installed."""
+
+    def __init__(self):
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.request = httplib2.Http.request
+
+    def __enter__(self) -> RequestTimer:
+        timer = self
+        request = self.request
+
+        def timed_request(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return request(self, *args, **kwargs)
+            finally:
+                with timer.lock:
+                    timer.latencies.append(time.perf_counter() - start)
+
+        httplib2.Http.request = timed_request
+        return self
+
+    def __exit__(self, *exc_info):
+        httplib2.Http.request = self.request
+
+def get_percentile(values: list[float], percentile: float) -> float:
+    """Returns the value below which the given percentage of the values fall."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))]
+
+def setup_listing(fake: fake_google.FakeGoogle, size: int) -> dict:
+    folder = fake.add_file("Listing", mime_type=fake_google.FOLDER_MIME_TYPE)
+    for i in range(size):
+        fake.add_file(f"File {i}.pdf", folder["id"])
+    return {"query": f"'{folder['id']}' in parents"}
+
+def setup_parent_update(fake: fake_google.FakeGoogle, size: int) -> dict:
+    source = fake.add_file("Source", mime_type=fake_google.FOLDER_MIME_TYPE)
+    destination = fake.add_file("Destination", mime_type=fake_google.FOLDER_MIME_TYPE)
+    files = [fake.add_file(f"File {i}.pdf", source["id"]) for i in range(size)]
+    return {"updates": [{"fileId": file["id"], "addParents": destination["id"], "removeParents": source["id"]} for file in files]}
+
+def setup_permissions(fake: fake_google.FakeGoogle, size: int) -> dict:
+    source = fake.add_file("Source", mime_type=fake_google.FOLDER_MIME_TYPE)
+    destination = fake.add_file("Destination", mime_type=fake_google.FOLDER_MIME_TYPE)
+    for i in range(size):
+        fake.add_permission(source["id"], {"type": "user", "role": "writer", "emailAddress": f"user{i}@example.com"})
+        # Half of them already exist with another role, so there are creates and updates
+        if i % 2:
+            fake.add_permission(destination["id"], {"type": "user", "role": "reader", "emailAddress": f"user{i}@example.com"})
+    return {"from_id": source["id"], "to_id": destination["id"]}
+
+def setup_sheet(fake: fake_google.FakeGoogle, size: int) -> dict:
+    spreadsheet = fake.add_spreadsheet("Benchmark", {"Access": [[f"row {i}", i, i * 2, "x" * 20] for i in range(size)]})
+    return {"sheet": {"spreadsheetId": spreadsheet["id"]}}
+
+def setup_workbook(fake: fake_google.FakeGoogle, size: int) -> dict:
+    tabs = {f"Tab {tab}": [[f"row {i}", i, tab] for i in range(size // 30)] for tab in range(30)}
+    # Led by a chart tab, which has no cells and has to be skipped
+    spreadsheet = fake.add_spreadsheet("Workbook", {"Chart": None, **tabs})
+    return {"ss_id": spreadsheet["id"]}
+
+# name: (size, setup, run)
+BENCHMARKS = {
+    "get_items_from_drive": (
+        5000, setup_listing,
+        lambda services, state, output: google_services.get_items_from_drive(services["drive"], state["query"])
+    ),
+    "iter_items_from_drive (prefetch)": (
+        5000, setup_listing,
+        lambda services, state, output: sum(1 for _ in google_services.iter_items_from_drive(services["drive"], state["query"]))
+    ),
+    "batch_update_parent": (
+        500, setup_parent_update,
+        lambda services, state, output: google_services.batch_update_parent(services["drive"], state["updates"])
+    ),
+    "replicate_permissions": (
+        300, setup_permissions,
+        lambda services, state, output: google_services.replicate_permissions(services["drive"], state["from_id"], state["to_id"])
+    ),
+    "save_as_csv": (
+        50000, setup_sheet,
+        lambda services, state, output: google_services.save_as_csv(services["sheets"], state["sheet"], os.path.join(output, "sheet.csv"), chunk_rows=0)
+    ),
+    "save_as_csv (chunked)": (
+        50000, setup_sheet,
+        lambda services, state, output: google_services.save_as_csv(services["sheets"], state["sheet"], os.path.join(output, "sheet.csv"), chunk_rows=5000)
+    ),
+    "export_all_sheets": (
+        30000, setup_workbook,
+        lambda services, state, output: google_services.export_all_sheets(services["sheets"], state["ss_id"], os.path.join(output, "workbook"))
+    ),
+}
+
+def run_benchmark(name: str, fake: fake_google.FakeGoogleProcess, output: str) -> dict:
+    """
+    Runs one benchmark twice, once timed and once with tracemalloc, each time on a fresh fake.
+
+    Args:
+        name (str): The name of the benchmark, see BENCHMARKS
+        fake (fake_google.FakeGoogleProcess): The fake APIs
+        output (str): The folder the helpers can write to
+
+    Returns:
+        dict: The results of the benchmark
+    """
+    size, setup, run = BENCHMARKS[name]
+
+    def run_once(trace_memory):
+        # New services every run, so no run reuses the connections of another
+        services = {
+            "drive": fake_google.create_fake_service("drive", "v3", fake.base_url),
+            "sheets": fake_google.create_fake_service("sheets", "v4", fake.base_url)
+        }
+        # The first use of a collection renders the schemas of its methods once per service, that isn't the helper's doing
+        services["drive"].files()
+        services["drive"].permissions()
+        services["sheets"].spreadsheets().values()
+        fake.reset()
+        state = fake.call(setup, size)
+        calls = fake.call(fake_google.get_call_count)
+        if trace_memory:
+            tracemalloc.start()
+        with RequestTimer() as timer, open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            run(services, state, output)
+            seconds = time.perf_counter() - start
+        peak = 0
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return seconds, fake.call(fake_google.get_call_count) - calls, timer.latencies, peak
+
+    seconds, calls, latencies, _ = run_once(False)
+    _, _, _, peak = run_once(True)
+    return {
+        "size": size,
+        "seconds": seconds,
+        "calls": calls,
+        "calls_per_second": calls / seconds if seconds else 0.0,
+        "requests": len(latencies),
+        "p50_ms": get_percentile(latencies, 50) * 1000,
+        "p95_ms": get_percentile(latencies, 95) * 1000,
+        "p99_ms": get_percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+        "peak_memory_mb": peak / 1024 / 1024
+    }
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Returns the regressions of the results against a baseline.
+
+    Args:
+        results (dict): The results by benchmark name
+        baseline (dict): Earlier results by benchmark name, see --save
+        tolerance (float): How much worse a result may be, e.g. 0.2 for 20%
+
+    Returns:
+        list[str]: A description of every regression
+    """
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["calls_per_second"] < before["calls_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: {result['calls_per_second']:.0f} calls/s, was {before['calls_per_second']:.0f}")
+        if result["peak_memory_mb"] > before["peak_memory_mb"] * (1 + tolerance) + 1:
+            regressions.append(f"{name}: {result['peak_memory_mb']:.1f} MB peak memory, was {before['peak_memory_mb']:.1f}")
+        if result["requests"] > before["requests"] * (1 + tolerance):
+            regressions.append(f"{name}: {result['requests']} requests, was {before['requests']}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="The benchmarks to run, all by default")
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds the fake APIs wait before answering a request")
+    parser.add_argument("--error-rate", type=float, default=0, help="Share of calls the fake APIs answer with a 429")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare the results to this JSON file and exit with 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="How much worse a result may be than the baseline")
+    args = parser.parse_args()
+
+    fake = fake_google.FakeGoogleProcess(latency=args.latency, error_rate=args.error_rate)
+    print(f"Fake APIs with {args.latency * 1000:.0f} ms latency and {args.error_rate:.0%} 429s")
+    print(f"{'benchmark':<34} {'size':>6} {'seconds':>8} {'calls':>6} {'calls/s':>8} {'requests':>8} {'p50 ms':>7} {'p95 ms':>7} {'p99 ms':>7} {'peak MB':>8}")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as output:
+        for name in args.benchmarks:
+            result = results[name] = run_benchmark(name, fake, output)
+            print(
+                f"{name:<34} {result['size']:>6} {result['seconds']:>8.2f} {result['calls']:>6} {result['calls_per_second']:>8.0f} "
+                f"{result['requests']:>8} {result['p50_ms']:>7.1f} {result['p95_ms']:>7.1f} {result['p99_ms']:>7.1f} {result['peak_memory_mb']:>8.1f}"
+            )
+    fake.close()
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+if __name__ == "__main__":
+    main()
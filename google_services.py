@@ -1,15 +1,90 @@
+from __future__ import annotations
+
 import csv
 import os
+import json
+import zipfile
 import re
 import io
 import time
-
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.discovery import Resource
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, BatchHttpRequest
+import queue
+import random
+import sqlite3
+import threading
+import email.utils
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import TYPE_CHECKING
+from urllib.parse import urlparse
 from googleapiclient.errors import HttpError
 
+# The auth, http and discovery libraries take most of the import time, so they are imported by the functions that use them
+if TYPE_CHECKING:
+    import httplib2
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import Resource
+    from googleapiclient.http import HttpRequest
+
+# Drive accepts at most 100 calls in a batch request
+BATCH_SIZE = 100
+
+# Errors worth retrying: rate limits and server errors
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = ["rateLimitExceeded", "userRateLimitExceeded"]
+
+# Sustained calls per second allowed per API, shared by all threads of the process, see RateLimiter.
+# Opt-in with e.g. GOOGLE_DRIVE_RATE_LIMIT=20, GOOGLE_SHEETS_RATE_LIMIT=1 or GOOGLE_DEFAULT_RATE_LIMIT=10 for other APIs.
+# Without them calls aren't slowed down up front, only paused for the Retry-After of a rate limit error
+RATE_LIMITS = {
+    api_name: float(os.environ[f"GOOGLE_{api_name.upper()}_RATE_LIMIT"])
+    for api_name in ("drive", "sheets")
+    if os.environ.get(f"GOOGLE_{api_name.upper()}_RATE_LIMIT")
+}
+DEFAULT_RATE_LIMIT = float(os.environ["GOOGLE_DEFAULT_RATE_LIMIT"]) if os.environ.get("GOOGLE_DEFAULT_RATE_LIMIT") else None
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+# The columns of the permissions table written by snapshot_permissions
+PERMISSION_COLUMNS = ["folder_id", "permission_id", "type", "role", "email_address", "domain", "inherited"]
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+
+# How long get_folder remembers a folder, in seconds. 0 turns the cache off
+FOLDER_CACHE_TTL = float(os.environ.get("GOOGLE_FOLDER_CACHE_TTL", "300"))
+# How many times get_folder looks a folder up again after creating it failed with a rate limit or server error
+FOLDER_CREATE_RETRIES = 3
+
+# The number of rows save_as_csv reads per request. 0 reads the whole range in one request
+SHEET_CHUNK_ROWS = int(os.environ.get("GOOGLE_SHEET_CHUNK_ROWS", "0"))
+
+# The most grid cells export_all_sheets asks for in one batchGet, to stay well under the response size limit
+SHEET_BATCH_MAX_CELLS = int(os.environ.get("GOOGLE_SHEET_BATCH_MAX_CELLS", "1000000"))
+
+# Parsed discovery documents, so services built later or on other threads don't load and parse them again
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+# (parent folder id, folder name) -> (folder, expiry time), see get_folder
+_folder_cache = {}
+_folder_cache_lock = threading.Lock()
+# Locks striped by (parent folder id, folder name), so concurrent calls don't create the same folder twice.
+# A fixed number, as a lock per folder would only ever grow
+_folder_locks = [threading.Lock() for _ in range(64)]
+
+# The fields the read helpers return when the caller doesn't ask for others.
+# Kept lean, as every extra field is sent and parsed for every item of a listing
+FILE_FIELDS = "id,name,mimeType"
+PERMISSION_FIELDS = "id,type,role,emailAddress,domain"
+SPREADSHEET_FIELDS = "spreadsheetId,properties.title,sheets.properties(title,sheetId,index,sheetType,gridProperties)"
+
+# The fields replicate_permissions needs to copy and compare permissions, see is_direct_permission
+REPLICATE_PERMISSION_FIELDS = "id,type,role,emailAddress,domain,allowFileDiscovery,permissionDetails"
+# The fields stored per permission by snapshot_permissions, see get_permission_row
+SNAPSHOT_PERMISSION_FIELDS = "id,type,role,emailAddress,domain,permissionDetails"
+# The fields stored per item in the drive index, see crawl_drive_tree
+INDEX_FIELDS = "id,name,mimeType,modifiedTime,permissionIds"
+
 def test():
     # Replace these with your actual values
     path_to_creds = 'credentials.json'
@@ -37,6 +112,8 @@ def test():
 def batch_update_parent(drive_service, batch_updates):
     """
     Updates the parents of multiple files in a batch using the Google Drive API.
+    The updates are split into batches of at most BATCH_SIZE calls, and updates that hit a rate limit
+    or server error are retried with backoff, see execute_batch.
 
     Args:
         drive_service: The authenticated Google Drive service object.
@@ -46,65 +123,32 @@ def batch_update_parent(drive_service, batch_updates):
                        - 'fileId': The ID of the file to update.
 
     Returns:
-        None. Prints success/failure messages for each file update.  Handles potential API errors.
+        dict: The result of every update, by file ID
+            'status': "success" or "error"
+            'parents': The new parent IDs of the file if it was updated
+            'error': The error message if the update failed
     """
-
-    batch = drive_service.new_batch_http_request(callback=process_response)
+    requests = {}
     for update in batch_updates:
         file_id = update['fileId']
-        # body = {
-        #     'addParents': update['addParents'],
-        #     'removeParents': update['removeParents']
-        # }
-
-        # drive_service.files().update(
-        #     supportsAllDrives=True,
-        #     fileId=id,
-        #     addParents=new_parent,
-        #     removeParents=old_parent,
-        #     fields='id, parents'
-        # ).execute()
-
-        request = drive_service.files().update(
+        requests[file_id] = drive_service.files().update(
             supportsAllDrives=True,
             fileId=file_id,
             addParents=update['addParents'],
             removeParents=update['removeParents'],
             fields='id, parents'
         )
-        batch.add(request, request_id=file_id)
-
-    try:
-        execute_with_retries(batch)
-    except Exception as e:
-        print(f"Error executing batch request: {e}")
 
-def execute_with_retries(batch, max_retries=3):
-    for attempt in range(max_retries):
-        try:
-            batch.execute()
-            return
-        except HttpError as e:
-            if e.resp.status in [500, 503]:
-                wait_time = (2 ** attempt) + (0.5 * attempt)
-                print(f"Retrying in {wait_time} seconds...")
-                time.sleep(wait_time)
-            else:
-                raise
-        # except TimeoutError:
-        #     wait_time = (2 ** attempt) + (0.5 * attempt)
-        #     print(f"Timeout occurred. Retrying in {wait_time} seconds...")
-        #     time.sleep(wait_time)
-        except Exception as e:
-            print(f"Batch execution failed: {e}\nCode: {e.resp.status}")
-            break  # Stop retrying for non-recoverable errors
+    results = {}
+    for file_id, (response, error) in execute_batch(drive_service, requests).items():
+        if error is not None:
+            print(f"Request ID: {file_id} - Error: {error}")
+            results[file_id] = {'status': "error", 'error': str(error)}
+        else:
+            results[file_id] = {'status': "success", 'parents': response.get('parents', [])}
 
-def process_response(request_id, response, exception):
-  """Callback function to handle the response from each batch request."""
-  if exception is not None:
-    print(f"Request ID: {request_id} - Error: {exception}")
-  else:
-      print(f"Request ID: {request_id} - File updated successfully: {response.get('id')}")
+    print(f"{sum(result['status'] == 'success' for result in results.values())} of {len(results)} files updated")
+    return results
 
 def stream_pdf_from_drive(drive_service: Resource, file_id: str) -> io.BytesIO:
     """
@@ -123,9 +167,12 @@ def stream_pdf_from_drive(drive_service: Resource, file_id: str) -> io.BytesIO:
     try:
         request = drive_service.files().get_media(fileId=file_id)
         file_stream = io.BytesIO()
+        from googleapiclient.http import MediaIoBaseDownload
         downloader = MediaIoBaseDownload(file_stream, request)
+        rate_limiter = get_rate_limiter(get_api_name(request.uri))
         done = False
         while not done:
+            rate_limiter.acquire()
             status, done = downloader.next_chunk()
         file_stream.seek(0)  # Reset stream position
         return file_stream
@@ -157,71 +204,407 @@ def upload_pdf_to_drive(drive_service: Resource, encrypted_stream, original_file
         if parent_folder_id:
             file_metadata["parents"] = [parent_folder_id]
         
+        from googleapiclient.http import MediaIoBaseUpload
         media = MediaIoBaseUpload(encrypted_stream, mimetype="application/pdf", resumable=True)
-        file = drive_service.files().create(body=file_metadata, media_body=media, fields="id").execute()
+        file = execute(drive_service.files().create(body=file_metadata, media_body=media, fields="id"))
         
         return file
     except Exception as e:
         print(f'An error occurred: {e}')
         return None
 
-def replicate_permissions(drive_service: Resource, from_drive_id: str, to_drive_id: str) -> str:
+def replicate_permissions(drive_service: Resource, from_drive_id: str, to_drive_id: str, update_roles: bool = True, remove_extra: bool = False) -> dict:
     """
     Replicate permissions from one drive to another.
+    User, group, domain and anyone permissions are matched on their type and email address or domain,
+    and the missing ones are created with batch requests.
 
     Args:
         drive_service (Resource): The authenticated drive service instance
         from_drive_id (str): The id of the drive to replicate its permissions
         to_drive_id (str): The id of the drive to have its permissions updated
+        update_roles (bool): Change the role of permissions that exist on both drives with different roles, except owners
+        remove_extra (bool): Delete the permissions that only exist on the drive being updated
+
+    Returns:
+        dict: The result of every change, by "<action>:<type>:<email address or domain>"
+            'action': "create", "update" or "delete"
+            'status': "success" or "error"
+            'error': The error message if the change failed
 
     Raises:
-        Exception: If an error occured.
+        Exception: If the permissions of either drive couldn't be read.
     """
-    from_permissions = get_permissions(drive_service, from_drive_id)
+    # A failed listing must not look like a drive without permissions, that would remove every permission with remove_extra
+    from_permissions = get_permissions(drive_service, from_drive_id, fields=REPLICATE_PERMISSION_FIELDS)
+    if from_permissions is None:
+        raise Exception(f"Could not get the permissions of {from_drive_id}")
+    from_permissions = index_permissions(from_permissions)
     print(f"Permissions to go through: {len(from_permissions)}")
-    # print(f"from_permissions: \n{from_permissions}")
 
-    to_permissions = get_permissions(drive_service, to_drive_id)
-    # print(f"to_permissions: \n{to_permissions}")
-    # return
+    to_permissions = get_permissions(drive_service, to_drive_id, fields=REPLICATE_PERMISSION_FIELDS)
+    if to_permissions is None:
+        raise Exception(f"Could not get the permissions of {to_drive_id}")
+    to_permissions = index_permissions(to_permissions)
+
+    requests = {}
+    for key, permission in from_permissions.items():
+        # Ownership can't be given away by creating a permission
+        if permission['role'] == "owner":
+            continue
+
+        to_permission = to_permissions.get(key)
+        if to_permission is None:
+            print(f"Adding permission: {':'.join(key)} to {to_drive_id}")
+            body = {
+                'type': permission['type'],
+                'role': permission['role']
+            }
+            for field in ('emailAddress', 'domain', 'allowFileDiscovery'):
+                if field in permission:
+                    body[field] = permission[field]
+
+            # Notification emails can only be turned off (or on) for users and groups
+            notification = {'sendNotificationEmail': False} if permission['type'] in ("user", "group") else {}
+            requests[f"create:{':'.join(key)}"] = drive_service.permissions().create(
+                fileId=to_drive_id,
+                body=body,
+                supportsAllDrives=True,
+                **notification
+            )
+        elif (update_roles and to_permission['role'] != permission['role'] and to_permission['role'] != "owner"
+                and is_direct_permission(to_permission)):
+            print(f"Updating permission: {':'.join(key)} on {to_drive_id} to {permission['role']}")
+            requests[f"update:{':'.join(key)}"] = drive_service.permissions().update(
+                fileId=to_drive_id,
+                permissionId=to_permission['id'],
+                body={'role': permission['role']},
+                supportsAllDrives=True
+            )
+
+    if remove_extra:
+        for key, to_permission in to_permissions.items():
+            if key not in from_permissions and to_permission['role'] != "owner" and is_direct_permission(to_permission):
+                print(f"Removing permission: {':'.join(key)} from {to_drive_id}")
+                requests[f"delete:{':'.join(key)}"] = drive_service.permissions().delete(
+                    fileId=to_drive_id,
+                    permissionId=to_permission['id'],
+                    supportsAllDrives=True
+                )
+
+    results = {}
+    for request_id, (response, error) in execute_batch(drive_service, requests).items():
+        results[request_id] = {
+            'action': request_id.split(":")[0],
+            'status': "error" if error else "success"
+        }
+        if error:
+            print(f"Error replicating permission {request_id}: {error}")
+            results[request_id]['error'] = str(error)
+
+    return results
+
+def index_permissions(permissions: list[dict]) -> dict:
+    """
+    Returns the permissions by who they are for, see get_permission_key.
+    Permissions without an email address or domain (e.g. of deleted users) are left out.
+
+    Args:
+        permissions (list[dict]): The permissions of a file or drive
+
+    Returns:
+        dict: The permissions by their key
+    """
+    index = {}
+    for permission in permissions:
+        key = get_permission_key(permission)
+        if key is not None:
+            index[key] = permission
+    return index
+
+def get_permission_key(permission: dict) -> tuple:
+    """
+    Returns what identifies who a permission is for, regardless of the file it is on.
+
+    Args:
+        permission (dict): The permission
+
+    Returns:
+        tuple: The type with the lowercase email address or domain, or None if it can't be identified
+    """
+    permission_type = permission.get('type')
+    if permission_type in ("user", "group"):
+        email = permission.get('emailAddress')
+        return (permission_type, email.lower()) if email else None
+    if permission_type == "domain":
+        domain = permission.get('domain')
+        return (permission_type, domain.lower()) if domain else None
+    if permission_type == "anyone":
+        return (permission_type, "")
+    return None
+
+def is_direct_permission(permission: dict) -> bool:
+    """
+    Returns False if the permission is only inherited from a parent folder, those can't be changed on the file itself.
+
+    Args:
+        permission (dict): The permission, with its permissionDetails
+
+    Returns:
+        bool: True if the permission is set on the file itself
+    """
+    details = permission.get('permissionDetails')
+    if not details:
+        return True
+    return any(not detail.get('inherited') for detail in details)
+
+def execute_batch(service: Resource, requests: dict, batch_size: int = BATCH_SIZE, max_retries: int = 3) -> dict:
+    """
+    Executes the requests with batch requests of at most batch_size calls.
+    Only the requests that failed with a rate limit or server error are retried, with exponential backoff.
+
+    Args:
+        service (Resource): The authenticated service instance the requests were made with
+        requests (dict): The requests to execute, by a unique request id
+        batch_size (int): The maximum number of requests in a batch
+        max_retries (int): How many times failed requests are retried
+
+    Returns:
+        dict: By request id, a tuple with the response and None, or None and the error if the request failed
+    """
+    results = {}
+
+    def callback(request_id, response, exception):
+        results[request_id] = (response, exception)
+
+    pending = list(requests)
+    if not pending:
+        return results
+    rate_limiter = get_rate_limiter(get_api_name(requests[pending[0]].uri))
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            wait_time = (2 ** attempt) + random.random()
+            print(f"Retrying {len(pending)} requests in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+
+        for start in range(0, len(pending), batch_size):
+            request_ids = pending[start:start + batch_size]
+            batch = service.new_batch_http_request(callback=callback)
+            for request_id in request_ids:
+                batch.add(requests[request_id], request_id=request_id)
+
+            # Every call in the batch counts towards the quota
+            rate_limiter.acquire(len(request_ids))
+            try:
+                batch.execute()
+            except Exception as e:
+                # The batch failed as a whole, so none of its requests got a response
+                print(f"Error executing batch request: {e}")
+                for request_id in request_ids:
+                    results[request_id] = (None, e)
+
+            rate_limited = [results[request_id][1] for request_id in request_ids if is_rate_limit_error(results[request_id][1])]
+            if rate_limited:
+                rate_limiter.on_rate_limited(max((get_retry_after(error) or 0) for error in rate_limited))
+            else:
+                rate_limiter.on_success()
+
+        pending = [request_id for request_id in pending if is_retryable_error(results[request_id][1])]
+        if not pending:
+            break
+
+    return results
 
-    for permission in from_permissions:
+def execute(request: HttpRequest, http: httplib2.Http = None, max_retries: int = 5) -> dict:
+    """
+    Executes a request through the rate limiter of its API.
+    Rate limit and server errors are retried with exponential backoff, and rate limit errors slow down
+    every other call to the same API, see RateLimiter.
+
+    Args:
+        request (HttpRequest): The request to execute, e.g. drive_service.files().get(fileId=file_id)
+        http (httplib2.Http): The connection to use instead of the service's, see new_http
+        max_retries (int): How many times the request is retried
+
+    Returns:
+        dict: The response of the request
+
+    Raises:
+        Exception: If an error occured.
+    """
+    rate_limiter = get_rate_limiter(get_api_name(request.uri))
+    for attempt in range(max_retries + 1):
+        rate_limiter.acquire()
         try:
-            email = permission.get('emailAddress')
-            print(f"Checking permissions for {email}")
-            if email: 
-                # Check if permission exists
-                add_permission = True
-                for to_permission in to_permissions:
-                    if to_permission['type'] == "user":
-                        if to_permission['emailAddress'] == email:
-                            add_permission = False
-                            break
-                
-                if add_permission:
-                    print(f"Adding permission: {email} to {to_drive_id}")
-                    drive_service.permissions().create(
-                        fileId=to_drive_id,
-                        body={
-                            'type': permission['type'],
-                            'role': permission['role'],
-                            'emailAddress': email
-                        },
-                        sendNotificationEmail=False,
-                        supportsAllDrives=True
-                    ).execute()
-        except Exception as e:
-            print(f"Error replicating permission: {e}")
-            
-    return "Success"
+            response = request.execute(http=http)
+            rate_limiter.on_success()
+            return response
+        except HttpError as e:
+            if not is_retryable_error(e) or attempt == max_retries:
+                raise
+            if is_rate_limit_error(e):
+                rate_limiter.on_rate_limited(get_retry_after(e))
+            wait_time = (2 ** attempt) * 0.5 + random.random()
+            print(f"Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+
+class RateLimiter:
+    """
+    Token bucket that limits the calls per second made to an API.
+
+    The rate adapts to the responses: it is halved whenever a call hits a rate limit and grows back
+    by a twentieth of max_rate for every successful call. A Retry-After from the API pauses all calls.
+    Without a max_rate the calls aren't limited, only paused by a Retry-After.
+    """
+
+    def __init__(self, max_rate: float = None, min_rate: float = 0.1):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.rate = max_rate
+        self.burst = max(1.0, max_rate or 0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int = 1):
+        """Waits until the calls can be made. More tokens than the burst can be taken at once, the debt is paid off after."""
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time <= 0:
+                return
+            time.sleep(wait_time)
+
+    def try_acquire(self, tokens: int = 1) -> float:
+        """Takes the tokens if they are available and returns 0, otherwise returns the seconds to wait before trying again."""
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.paused_until - now
+            if wait_time > 0:
+                return wait_time
+            if not self.max_rate:
+                return 0
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= min(tokens, self.burst):
+                self.tokens -= tokens
+                return 0
+            return (min(tokens, self.burst) - self.tokens) / self.rate
+
+    def on_success(self):
+        if not self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def on_rate_limited(self, retry_after: float = None):
+        with self.lock:
+            if self.max_rate:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+def get_rate_limiter(api_name: str) -> RateLimiter:
+    """
+    Returns the rate limiter shared by all calls to the API, see RATE_LIMITS.
+
+    Args:
+        api_name (str): The name of the API, e.g. 'drive', see get_api_name
+
+    Returns:
+        RateLimiter: The rate limiter of the API
+    """
+    with _rate_limiters_lock:
+        if api_name not in _rate_limiters:
+            _rate_limiters[api_name] = RateLimiter(RATE_LIMITS.get(api_name, DEFAULT_RATE_LIMIT))
+        return _rate_limiters[api_name]
+
+def get_api_name(uri: str) -> str:
+    """
+    Returns the name of the API a request is for.
+
+    Args:
+        uri (str): The uri of the request, e.g. https://www.googleapis.com/drive/v3/files
+
+    Returns:
+        str: The name of the API, e.g. 'drive' or 'sheets'
+
+    Example:
+        get_api_name('https://sheets.googleapis.com/v4/spreadsheets/<id>') returns 'sheets'
+    """
+    parsed = urlparse(uri)
+    host = parsed.netloc.split(".")[0]
+    if host != "www":
+        return host
+
+    # e.g. /drive/v3/files, /upload/drive/v3/files or /batch/drive/v3
+    parts = [part for part in parsed.path.split("/") if part and part not in ("upload", "batch")]
+    return parts[0] if parts else host
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Returns True if the error means the request was rejected because of a rate limit.
+
+    Args:
+        error (Exception): The error of the request, or None if it succeeded
+
+    Returns:
+        bool: True if a rate limit was hit
+    """
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    details = error.error_details if isinstance(error.error_details, list) else []
+    return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details)
+
+def get_retry_after(error: HttpError) -> float:
+    """
+    Returns the number of seconds the API asked to wait before retrying.
+
+    Args:
+        error (HttpError): The error of the request
+
+    Returns:
+        float: The seconds to wait, or None if the API didn't say
+    """
+    retry_after = error.resp.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
 
-def get_permissions(drive_service: Resource, folder_id: str) -> list[dict]:
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Returns True if the request that raised the error is worth retrying, i.e. it hit a rate limit or a server error.
+
+    Args:
+        error (Exception): The error of the request, or None if it succeeded
+
+    Returns:
+        bool: True if the request should be retried
+    """
+    if not isinstance(error, HttpError):
+        return False
+    return error.resp.status in RETRYABLE_STATUSES or is_rate_limit_error(error)
+
+def get_permissions(drive_service: Resource, folder_id: str, fields: str | list[str] = PERMISSION_FIELDS) -> list[dict]:
     """
     Gets the permissions from a drive.
 
     Args:
         drive_service (Resource): The authenticated drive service instance
         folder_id (str): The id of the drive to return its permissions
+        fields (str | list[str]): The fields to return per permission, e.g. "id,role" or "*" for all of them
 
     Returns:
         list[dict]: The list with all the permissions
@@ -230,38 +613,181 @@ def get_permissions(drive_service: Resource, folder_id: str) -> list[dict]:
         Exception: If an error occured.
     """
     try:
-        permissions_list = []
-        pageToken = None
+        return list(iter_permissions(drive_service, folder_id, fields=fields))
+    except Exception as e:
+            print(f"Error replicating permission: {e}")
 
-        while True:
-            request = drive_service.permissions().list(
-                fileId=folder_id,
-                supportsAllDrives=True,
-                pageSize=100,
-                pageToken=pageToken,
-                fields="permissions(id,emailAddress,role,type,permissionDetails),nextPageToken"
-            ).execute()
+def iter_permissions(drive_service: Resource, folder_id: str, http: httplib2.Http = None, fields: str | list[str] = PERMISSION_FIELDS):
+    """
+    Yields the permissions of a drive, file or folder, one page at a time.
 
-            permissions = request.get("permissions", [])
-            permissions_list = permissions_list + permissions
-            
-            pageToken = request.get("nextPageToken", None)
-            if not pageToken:
-                break
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        folder_id (str): The id of the drive, file or folder
+        http (httplib2.Http): The connection to use instead of the service's, see new_http
+        fields (str | list[str]): The fields to return per permission, e.g. "id,role" or "*" for all of them
 
-        return permissions_list
-    except Exception as e:
-            print(f"Error replicating permission: {e}")
+    Yields:
+        dict: The permissions
+
+    Raises:
+        Exception: If an error occured.
+    """
+    pageToken = None
+
+    while True:
+        # 100 is the most the API returns per page
+        request = execute(drive_service.permissions().list(
+            fileId=folder_id,
+            supportsAllDrives=True,
+            pageSize=100,
+            pageToken=pageToken,
+            fields=get_fields_mask(fields, "permissions")
+        ), http=http)
+
+        yield from request.get("permissions", [])
+        
+        pageToken = request.get("nextPageToken", None)
+        if not pageToken:
+            break
+
+def snapshot_permissions(drive_service: Resource, folder_ids: list[str], output_path: str, max_workers: int = 8) -> dict:
+    """
+    Fetches the permissions of many drives, files or folders at the same time and writes them to a table on disk.
+    The permissions are written as they come in, so memory use doesn't grow with the number of folders.
+
+    The table is a CSV file if output_path ends with .csv, otherwise it is the "permissions" table of a SQLite
+    database, which is emptied first. Either way the columns are PERMISSION_COLUMNS.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        folder_ids (list[str]): The ids of the drives, files or folders
+        output_path (str): The CSV or SQLite file to write to
+        max_workers (int): The number of folders to fetch at the same time
+
+    Returns:
+        dict: A summary of the snapshot
+            'folders': The number of folders
+            'permissions': The number of permissions written
+            'errors': The error message by folder id, for the folders that failed
+
+    Raises:
+        Exception: If an error occured.
+    """
+    print(f"Taking a snapshot of the permissions of {len(folder_ids)} folders")
+    # Bounded, so the workers wait for the writer instead of piling up rows in memory
+    rows = queue.Queue(maxsize=10000)
+    errors = {}
+    pool = ServicePool.from_service(drive_service)
+    # Set when the writer is done or failed, so the workers stop instead of waiting for room in the queue forever
+    stop = threading.Event()
+
+    def put(row):
+        while not stop.is_set():
+            try:
+                rows.put(row, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def snapshot_folder(folder_id):
+        if stop.is_set():
+            return
+        try:
+            for permission in iter_permissions(drive_service, folder_id, http=pool.get_http(), fields=SNAPSHOT_PERMISSION_FIELDS):
+                if not put(get_permission_row(folder_id, permission)):
+                    return
+        except Exception as e:
+            print(f"Error getting the permissions of {folder_id}: {e}")
+            errors[folder_id] = str(e)
 
-def get_folder(drive_service: Resource, parent_folder_id: str, folder_name: str) -> dict:
+    def fetch_all():
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for _ in executor.map(snapshot_folder, folder_ids):
+                    pass
+        finally:
+            pool.close()
+            put(None)
+
+    count = 0
+    path = os.path.dirname(output_path)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
+    # The output is opened and prepared before the workers start, so a bad output fails before anything is fetched
+    is_csv = output_path.lower().endswith(".csv")
+    output = open(output_path, mode='w', newline='', encoding='utf-8') if is_csv else sqlite3.connect(output_path)
+    try:
+        if is_csv:
+            writer = csv.writer(output)
+            writer.writerow(PERMISSION_COLUMNS)
+        else:
+            output.execute(f"CREATE TABLE IF NOT EXISTS permissions ({', '.join(PERMISSION_COLUMNS)})")
+            output.execute("CREATE INDEX IF NOT EXISTS permissions_folder_id ON permissions (folder_id)")
+            output.execute("DELETE FROM permissions")
+            insert = f"INSERT INTO permissions VALUES ({', '.join('?' * len(PERMISSION_COLUMNS))})"
+
+        threading.Thread(target=fetch_all, daemon=True).start()
+
+        if is_csv:
+            for row in iter(rows.get, None):
+                writer.writerow(row)
+                count += 1
+        else:
+            batch = []
+            for row in iter(rows.get, None):
+                batch.append(row)
+                if len(batch) >= 1000:
+                    output.executemany(insert, batch)
+                    count += len(batch)
+                    batch = []
+            output.executemany(insert, batch)
+            count += len(batch)
+            output.commit()
+    finally:
+        stop.set()
+        output.close()
+
+    print(f"{count} permissions written to {output_path}")
+    return {'folders': len(folder_ids), 'permissions': count, 'errors': errors}
+
+def get_permission_row(folder_id: str, permission: dict) -> tuple:
+    """
+    Returns a permission as a row of PERMISSION_COLUMNS, see snapshot_permissions.
+
+    Args:
+        folder_id (str): The id of the drive, file or folder the permission is on
+        permission (dict): The permission
+
+    Returns:
+        tuple: The row
+    """
+    return (
+        folder_id,
+        permission.get('id'),
+        permission.get('type'),
+        permission.get('role'),
+        permission.get('emailAddress'),
+        permission.get('domain'),
+        not is_direct_permission(permission)
+    )
+
+def get_folder(drive_service: Resource, parent_folder_id: str, folder_name: str, http: httplib2.Http = None) -> dict:
     """
     Returns the folder with the specified name in the specified parent folder. 
     If the folder can't be found, it will create the folder and return it.
 
+    Folders are remembered for FOLDER_CACHE_TTL seconds, so looking up the same folder again doesn't call the API,
+    see invalidate_folder_cache. Concurrent calls for the same folder wait for each other instead of creating it twice,
+    and a create that fails with a server error is only tried again if looking the folder up again doesn't find it.
+
     Args:
         drive_service (Resource): The authenticated drive service instance
         parent_folder_id (str): The id of the parent folder
         folder_name (str): The name of the folder to search for
+        http (httplib2.Http): The connection to use instead of the service's, see new_http
 
     Returns:
         dict: The File Resource of the found or created folder
@@ -269,31 +795,158 @@ def get_folder(drive_service: Resource, parent_folder_id: str, folder_name: str)
     Raises:
         Exception: If an error occured.
     """
+    key = (parent_folder_id, folder_name)
     try:
-        query = f"'{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and name='{folder_name}' and trashed=false"
-        response = drive_service.files().list(q=query, supportsAllDrives=True, includeItemsFromAllDrives=True).execute()
-        folders = response.get('files', [])
-        if folders:
-            return folders[0]
-        else:
-            folder_metadata = {
-                'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
-                'parents': [parent_folder_id]
-            }
-            folder = drive_service.files().create(body=folder_metadata, supportsAllDrives=True).execute()
+        folder = get_cached_folder(key)
+        if folder:
+            return folder
+
+        with _folder_locks[hash(key) % len(_folder_locks)]:
+            # Another thread may have found or created it while this one waited
+            folder = get_cached_folder(key)
+            if folder:
+                return folder
+
+            escaped_name = folder_name.replace("\\", "\\\\").replace("'", "\\'")
+            query = f"'{parent_folder_id}' in parents and mimeType='{FOLDER_MIME_TYPE}' and name='{escaped_name}' and trashed=false"
+            for attempt in range(FOLDER_CREATE_RETRIES + 1):
+                response = execute(drive_service.files().list(
+                    q=query,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    # The oldest one, if duplicates were created elsewhere
+                    orderBy="createdTime"
+                ), http=http)
+                folders = response.get('files', [])
+                if folders:
+                    folder = folders[0]
+                    break
+
+                folder_metadata = {
+                    'name': folder_name,
+                    'mimeType': FOLDER_MIME_TYPE,
+                    'parents': [parent_folder_id]
+                }
+                try:
+                    # Not retried as is, a create that failed with a server error may still have created the folder
+                    folder = execute(drive_service.files().create(body=folder_metadata, supportsAllDrives=True), http=http, max_retries=0)
+                    break
+                except HttpError as e:
+                    if not is_retryable_error(e) or attempt == FOLDER_CREATE_RETRIES:
+                        raise
+                    wait_time = (2 ** attempt) * 0.5 + random.random()
+                    print(f"Creating folder {folder_name} failed, looking it up again in {wait_time:.1f} seconds...")
+                    time.sleep(wait_time)
+
+            if FOLDER_CACHE_TTL > 0:
+                with _folder_cache_lock:
+                    _folder_cache[key] = (folder, time.monotonic() + FOLDER_CACHE_TTL)
             return folder
     except Exception as e:
         print(f'An error occurred: {e}')
         return None
+
+def get_cached_folder(key: tuple) -> dict:
+    """
+    Returns the folder remembered by get_folder, or None if it isn't cached or has expired.
+
+    Args:
+        key (tuple): The id of the parent folder and the name of the folder
+
+    Returns:
+        dict: The File Resource of the folder
+    """
+    with _folder_cache_lock:
+        folder, expires = _folder_cache.get(key, (None, 0))
+        if expires > time.monotonic():
+            return folder
+        _folder_cache.pop(key, None)
+        return None
+
+def invalidate_folder_cache(parent_folder_id: str = None, folder_name: str = None):
+    """
+    Forgets folders remembered by get_folder, e.g. after they were renamed, moved or deleted.
+
+    Args:
+        parent_folder_id (str): Only forget the folders in this parent folder, all folders if not given
+        folder_name (str): Only forget the folders with this name
+    """
+    with _folder_cache_lock:
+        for key in list(_folder_cache):
+            if parent_folder_id not in (None, key[0]) or folder_name not in (None, key[1]):
+                continue
+            del _folder_cache[key]
+
+def get_folder_path(drive_service: Resource, root_folder_id: str, path: str, http: httplib2.Http = None) -> dict:
+    """
+    Returns the folder at the given path below the root folder, creating the folders that are missing.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        root_folder_id (str): The id of the folder the path starts in
+        path (str): The folder names separated by /, e.g. '2026/Q3/Client'
+        http (httplib2.Http): The connection to use instead of the service's, see new_http
+
+    Returns:
+        dict: The File Resource of the last folder in the path
+
+    Raises:
+        Exception: If an error occured.
+    """
+    folder = {'id': root_folder_id}
+    for folder_name in [name for name in path.split("/") if name]:
+        folder = get_folder(drive_service, folder['id'], folder_name, http=http)
+        if folder is None:
+            return None
+    return folder
+
+def ensure_folder_paths(drive_service: Resource, root_folder_id: str, paths: list[str], max_workers: int = 8) -> dict:
+    """
+    Makes sure all the given folder paths exist below the root folder, creating only the folders that are missing.
+    Paths are resolved one level at a time, every shared prefix only once, and the folders of a level at the same time.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        root_folder_id (str): The id of the folder the paths start in
+        paths (list[str]): The paths, with folder names separated by /, e.g. ['2026/Q3/Client A', '2026/Q3/Client B']
+        max_workers (int): The number of folders to look up or create at the same time
+
+    Returns:
+        dict: The File Resource of the last folder by path, None for the paths that failed
+
+    Raises:
+        Exception: If an error occured.
+    """
+    split_paths = {path: tuple(name for name in path.split("/") if name) for path in paths}
+    folders = {(): {'id': root_folder_id}}
+    pool = ServicePool.from_service(drive_service)
+
+    def resolve(prefix):
+        parent = folders.get(prefix[:-1])
+        if parent is None:
+            return None
+        return get_folder(drive_service, parent['id'], prefix[-1], http=pool.get_http())
+
+    depth = max((len(names) for names in split_paths.values()), default=0)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for level in range(1, depth + 1):
+                prefixes = list({names[:level] for names in split_paths.values() if len(names) >= level})
+                for prefix, folder in zip(prefixes, executor.map(resolve, prefixes)):
+                    folders[prefix] = folder
+    finally:
+        pool.close()
+
+    return {path: folders.get(names) for path, names in split_paths.items()}
     
-def get_file(drive_service: Resource, file_id: str) -> dict:
+def get_file(drive_service: Resource, file_id: str, fields: str | list[str] = FILE_FIELDS) -> dict:
     """
     Returns the file with the given id.
 
     Args:
         drive_service (Resource): The authenticated drive service instance
         file_id (str): The id of the file
+        fields (str | list[str]): The fields to return, e.g. "id,name,md5Checksum,size" or "*" for all of them
 
     Returns:
         dict: The File Resource of the file
@@ -302,11 +955,11 @@ def get_file(drive_service: Resource, file_id: str) -> dict:
         Exception: If an error occured.
     """
     try:
-        response = drive_service.files().get(
+        response = execute(drive_service.files().get(
             fileId=file_id, 
             supportsAllDrives=True,
-            fields="kind,id,name,mimeType,parents,webViewLink"
-        ).execute()
+            fields=get_fields_mask(fields)
+        ))
         # print(response)
         return response
     except Exception as e:
@@ -332,13 +985,13 @@ def move_file(drive_service: Resource, id: str, new_parent: str, old_parent: str
     print(f"Updating the parent of: {id}")
     try:
         # Update the parent
-        item = drive_service.files().update(
+        item = execute(drive_service.files().update(
             supportsAllDrives=True,
             fileId=id,
             addParents=new_parent,
             removeParents=old_parent,
             fields='id, parents'
-        ).execute()
+        ))
         print(f"Updated file ID {id} to new parent ID {new_parent}")
 
         return item
@@ -364,17 +1017,17 @@ def update_parent_folder(drive_service: Resource, id: str, new_parent: str) -> d
     print(f"Updating the parent of: {id}")
     try:
         # Get the current parent IDs
-        file_metadata = drive_service.files().get(fileId=id, supportsAllDrives=True, fields='parents').execute()
+        file_metadata = execute(drive_service.files().get(fileId=id, supportsAllDrives=True, fields='parents'))
         old_parents = ",".join(file_metadata.get('parents', []))
 
         # Update the parent
-        item = drive_service.files().update(
+        item = execute(drive_service.files().update(
             supportsAllDrives=True,
             fileId=id,
             addParents=new_parent,
             removeParents=old_parents,
             fields='id, parents'
-        ).execute()
+        ))
         print(f"Updated file ID {id} to new parent ID {new_parent}")
 
         return item
@@ -382,14 +1035,19 @@ def update_parent_folder(drive_service: Resource, id: str, new_parent: str) -> d
         print(f'An error occurred: {e}')
         return None
 
-def save_as_csv(sheet_service: Resource, sheet: dict, location: str) -> str:
+def save_as_csv(sheet_service: Resource, sheet: dict, location: str, range_name: str = "Access", chunk_rows: int = None) -> str:
     """
     Saves the current Google Sheet as a CSV file in the specified location
 
+    With chunk_rows, the range is read a window of rows at a time and every window is written as it comes in,
+    while the next one is being read, so large sheets don't have to fit in memory, see iter_sheet_rows.
+
     Args:
         sheet_service (Resource): The authenticated sheet service instance
         sheet (dict): A dict representing a Google Sheet file
         location (str): The location where to save the CSV
+        range_name (str): The tab or range to save, e.g. 'Access' or 'Access!A:F'
+        chunk_rows (int): The number of rows to read per request, defaults to SHEET_CHUNK_ROWS. 0 reads the range at once
 
     Returns:
         str: The File Resource of the newly created spreadsheet
@@ -400,10 +1058,10 @@ def save_as_csv(sheet_service: Resource, sheet: dict, location: str) -> str:
     print("Saving a Google Sheet as a CSV")
     try:
         # Retrieve data from the specified range
-        result = sheet_service.spreadsheets().values().get(spreadsheetId=sheet.get('spreadsheetId'), range="Access").execute()
-        values = result.get('values', [])
+        rows = iter_sheet_rows(sheet_service, sheet, range_name, chunk_rows)
+        first_row = next(rows, None)
 
-        if not values:
+        if first_row is None:
             print("No data found in the specified range.")
             return
         
@@ -417,7 +1075,8 @@ def save_as_csv(sheet_service: Resource, sheet: dict, location: str) -> str:
         # Write data to CSV
         with open(location, mode='w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
-            writer.writerows(values)
+            writer.writerow(first_row)
+            writer.writerows(rows)
             print(f"CSV file saved successfully at {location}")
 
         return "Success!"
@@ -425,13 +1084,284 @@ def save_as_csv(sheet_service: Resource, sheet: dict, location: str) -> str:
         print(f'An error occurred: {e}')
         return None
 
-def get_spreadsheet(sheet_service: Resource, ss_id: str) -> dict:
+def iter_sheet_rows(sheet_service: Resource, sheet: dict, range_name: str, chunk_rows: int = None):
+    """
+    Yields the rows of a range of a Google Sheet.
+
+    With chunk_rows, the range is read a window of rows at a time, and the next window is requested on a background
+    thread while the caller works through the current one. Blank rows between windows are yielded as empty rows,
+    blank rows at the end are left out, like a single read does.
+
+    Args:
+        sheet_service (Resource): The authenticated sheet service instance
+        sheet (dict): A dict representing a Google Sheet file
+        range_name (str): The tab or range to read, e.g. 'Access' or 'Access!A:F'
+        chunk_rows (int): The number of rows to read per request, defaults to SHEET_CHUNK_ROWS. 0 reads the range at once
+
+    Yields:
+        list: The values of a row
+
+    Raises:
+        Exception: If an error occured.
+    """
+    ss_id = sheet.get('spreadsheetId')
+    chunk_rows = SHEET_CHUNK_ROWS if chunk_rows is None else chunk_rows
+
+    tab, cells = split_range(range_name)
+    match = re.fullmatch(r"([A-Za-z]*)(\d*):([A-Za-z]*)(\d*)", cells) if cells else None
+    if chunk_rows <= 0 or (cells and not match):
+        # A single cell or named range isn't worth splitting up
+        result = execute(sheet_service.spreadsheets().values().get(spreadsheetId=ss_id, range=range_name))
+        yield from result.get('values', [])
+        return
+
+    start_column, start_row, end_column, end_row = match.groups() if match else ("", "", "", "")
+    # Without an end row, the windows go on until the last row of the tab
+    last_row = int(end_row) if end_row else get_row_count(sheet_service, sheet, tab)
+    first_row = int(start_row) if start_row else 1
+    if not tab.startswith("'"):
+        tab = quote_sheet_title(tab)
+
+    # Built once, every collection renders the docstrings of all its methods, which is a lot for Sheets
+    values_collection = sheet_service.spreadsheets().values()
+
+    def get_window(start):
+        end = min(start + chunk_rows - 1, last_row)
+        window = f"{tab}!{start_column}{start}:{end_column}{end}"
+        return execute(values_collection.get(spreadsheetId=ss_id, range=window), http=pool.get_http())
+
+    # The service's connection isn't thread safe, so the background thread gets its own
+    pool = ServicePool.from_service(sheet_service)
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = None
+    try:
+        blank_rows = 0
+        start = first_row
+        future = executor.submit(get_window, start) if start <= last_row else None
+        while future:
+            values = future.result().get('values', [])
+
+            next_start = start + chunk_rows
+            future = executor.submit(get_window, next_start) if next_start <= last_row else None
+
+            if values:
+                # Trailing blank rows of a window are left out by the API, but do belong before the next one
+                for _ in range(blank_rows):
+                    yield []
+                yield from values
+                blank_rows = 0
+            blank_rows += min(chunk_rows, last_row - start + 1) - len(values)
+            start = next_start
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Closed once the window being prefetched, if any, is in, also when the caller stops early
+        if future is None:
+            pool.close()
+        else:
+            future.add_done_callback(lambda _: pool.close())
+
+def export_all_sheets(sheet_service: Resource, ss_id: str, location: str, max_workers: int = 4) -> dict:
+    """
+    Saves every tab of a Google Sheet as a CSV file, with as few requests as possible.
+
+    The tabs are fetched in batchGet groups of at most SHEET_BATCH_MAX_CELLS cells, and the groups are fetched and
+    written at the same time. A tab bigger than that on its own is read in row windows, see iter_sheet_rows.
+
+    Args:
+        sheet_service (Resource): The authenticated sheet service instance
+        ss_id (str): The ID of the spreadsheet to export
+        location (str): The folder to save a CSV per tab in, or a .zip file to save them all in
+        max_workers (int): The number of groups to fetch at the same time
+
+    Returns:
+        dict: A summary of the export
+            'tabs': The number of tabs
+            'files': The CSV file, or the name inside the zip file, by tab title. Empty tabs are left out
+            'skipped': The titles of the tabs that aren't grids, e.g. charts, they have no values to export
+            'errors': The error message by tab title, for the tabs that failed
+
+    Raises:
+        Exception: If an error occured.
+
+    Example:
+        export_all_sheets(sheet_service, ss_id, 'exports/workbook.zip')
+    """
+    sheet = get_spreadsheet(sheet_service, ss_id)
+    if sheet is None:
+        return None
+    tabs = [tab['properties'] for tab in sheet.get('sheets', [])]
+    print(f"Exporting {len(tabs)} tabs of {ss_id}")
+
+    # Only grid tabs have values, a range of a chart tab fails the whole batchGet it is in
+    skipped = [tab['title'] for tab in tabs if tab.get('sheetType', "GRID") != "GRID"]
+    grid_tabs = [tab for tab in tabs if tab.get('sheetType', "GRID") == "GRID"]
+
+    # Decided up front, in tab order, so titles that only differ in the characters that are replaced
+    # (e.g. a/b and a:b) get their own file instead of overwriting each other
+    file_names = {}
+    used_names = set()
+    for tab in grid_tabs:
+        name = re.sub(r'[\\/:*?"<>|]', '_', tab['title'])
+        file_name = name
+        counter = 1
+        while file_name.lower() in used_names:
+            counter += 1
+            file_name = f"{name} ({counter})"
+        used_names.add(file_name.lower())
+        file_names[tab['title']] = file_name + ".csv"
+
+    # Groups of tabs that fit in one batchGet, tabs that don't fit on their own are read in row windows
+    groups = [[]]
+    large_tabs = []
+    group_cells = 0
+    for tab in grid_tabs:
+        grid = tab.get('gridProperties', {})
+        cells = grid.get('rowCount', 0) * grid.get('columnCount', 0)
+        if cells > SHEET_BATCH_MAX_CELLS:
+            large_tabs.append(tab)
+            continue
+        if group_cells + cells > SHEET_BATCH_MAX_CELLS:
+            groups.append([])
+            group_cells = 0
+        groups[-1].append(tab)
+        group_cells += cells
+    groups = [group for group in groups if group]
+
+    is_archive = location.lower().endswith(".zip")
+    path = os.path.dirname(location) if is_archive else location
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+    archive = zipfile.ZipFile(location, mode='w', compression=zipfile.ZIP_DEFLATED) if is_archive else None
+
+    files = {}
+    errors = {}
+    archive_lock = threading.Lock()
+    pool = ServicePool.from_service(sheet_service)
+
+    def write_tab(title, rows):
+        rows = iter(rows)
+        first_row = next(rows, None)
+        if first_row is None:
+            print(f"No data found in {title}")
+            return
+        file_name = file_names[title]
+        if archive:
+            # Only one file in a zip can be written at a time
+            with archive_lock, archive.open(file_name, mode='w') as binary_file:
+                with io.TextIOWrapper(binary_file, encoding='utf-8', newline='') as file:
+                    writer = csv.writer(file)
+                    writer.writerow(first_row)
+                    writer.writerows(rows)
+        else:
+            file_name = os.path.join(location, file_name)
+            with open(file_name, mode='w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerow(first_row)
+                writer.writerows(rows)
+        files[title] = file_name
+
+    def export_group(group):
+        titles = [tab['title'] for tab in group]
+        value_ranges = batch_get_values(sheet_service, ss_id, [quote_sheet_title(title) for title in titles], http=pool.get_http())
+        if value_ranges is None:
+            errors.update({title: "The batchGet request failed" for title in titles})
+            return
+        for title, value_range in zip(titles, value_ranges):
+            try:
+                write_tab(title, value_range.get('values', []))
+            except Exception as e:
+                print(f"Error writing {title}: {e}")
+                errors[title] = str(e)
+
+    def export_large_tab(tab):
+        try:
+            columns = max(1, tab.get('gridProperties', {}).get('columnCount', 1))
+            chunk_rows = SHEET_CHUNK_ROWS or max(1, SHEET_BATCH_MAX_CELLS // columns)
+            write_tab(tab['title'], iter_sheet_rows(sheet_service, sheet, quote_sheet_title(tab['title']) + "!1:" + str(tab['gridProperties']['rowCount']), chunk_rows))
+        except Exception as e:
+            print(f"Error exporting {tab['title']}: {e}")
+            errors[tab['title']] = str(e)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(export_group, group) for group in groups]
+            futures += [executor.submit(export_large_tab, tab) for tab in large_tabs]
+            for future in futures:
+                future.result()
+    finally:
+        pool.close()
+        if archive:
+            archive.close()
+
+    print(f"{len(files)} tabs saved to {location}")
+    return {'tabs': len(tabs), 'files': files, 'skipped': skipped, 'errors': errors}
+
+def quote_sheet_title(title: str) -> str:
+    """
+    Returns the title of a tab quoted for use in a range, e.g. 'My Tab'!A1:B2.
+    Titles are always quoted, as the API reads bare titles that look like a cell, e.g. Q1 or FY2024, as one.
+
+    Args:
+        title (str): The title of the tab
+
+    Returns:
+        str: The quoted title
+    """
+    return "'" + title.replace("'", "''") + "'"
+
+def split_range(range_name: str) -> tuple[str, str]:
+    """
+    Splits a range into its tab and cells, e.g. "'Q1!Sales'!A1:B2" into "'Q1!Sales'" and "A1:B2".
+    A quoted tab ends at its closing quote, so a ! in its title isn't taken for the start of the cells.
+
+    Args:
+        range_name (str): The tab or range, e.g. 'Access' or 'Access!A:F'
+
+    Returns:
+        tuple[str, str]: The tab as given, quoted or not, and the cells, empty if the range is a whole tab
+    """
+    match = re.fullmatch(r"('(?:[^']|'')*')(?:!(.*))?", range_name, re.DOTALL)
+    if match:
+        return match.group(1), match.group(2) or ""
+    tab, _, cells = range_name.partition("!")
+    return tab, cells
+
+def get_row_count(sheet_service: Resource, sheet: dict, tab: str) -> int:
+    """
+    Returns the number of rows of a tab of a Google Sheet, including the blank ones.
+
+    Args:
+        sheet_service (Resource): The authenticated sheet service instance
+        sheet (dict): A dict representing a Google Sheet file, if it has its tabs they are used instead of calling the API
+        tab (str): The title of the tab, quoted or not
+
+    Returns:
+        int: The number of rows
+
+    Raises:
+        Exception: If the tab can't be found.
+    """
+    title = tab[1:-1].replace("''", "'") if tab.startswith("'") and tab.endswith("'") else tab
+    tabs = sheet.get('sheets')
+    if not tabs or not all('gridProperties' in tab.get('properties', {}) for tab in tabs):
+        tabs = execute(sheet_service.spreadsheets().get(
+            spreadsheetId=sheet.get('spreadsheetId'),
+            fields='sheets.properties.title,sheets.properties.gridProperties'
+        )).get('sheets', [])
+
+    for properties in [tab['properties'] for tab in tabs]:
+        if properties['title'] == title:
+            return properties['gridProperties']['rowCount']
+    raise Exception(f"Tab {title} not found in spreadsheet {sheet.get('spreadsheetId')}")
+
+def get_spreadsheet(sheet_service: Resource, ss_id: str, fields: str | list[str] = SPREADSHEET_FIELDS) -> dict:
     """
     Returns the spreadsheet with the specified id
 
     Args:
         sheet_service (Resource): The authenticated sheet service instance
         ss_id (str): The ID of the spreadsheet to return
+        fields (str | list[str]): The fields to return, by default the title and the properties of every tab
 
     Returns:
         dict: The File Resource of the spreadsheet
@@ -441,16 +1371,16 @@ def get_spreadsheet(sheet_service: Resource, ss_id: str) -> dict:
     """
     print(f"Getting Google Sheet: {ss_id}")
     try:
-        sheet = sheet_service.spreadsheets().get(
+        sheet = execute(sheet_service.spreadsheets().get(
             spreadsheetId=ss_id, 
-            fields='spreadsheetId,properties.title,sheets.properties.title,sheets.properties.sheetId,sheets.properties.index,sheets.properties.gridProperties'
-        ).execute()
+            fields=get_fields_mask(fields)
+        ))
         return sheet
     except Exception as e:
         print(f'An error occurred: {e}')
         return None
 
-def batch_get_values(sheet_service: Resource, ss_id: str, range_names: list[str]) -> dict:
+def batch_get_values(sheet_service: Resource, ss_id: str, range_names: list[str], http: httplib2.Http = None) -> dict:
   """
     Returns the data for the specified ranges of the Google Sheet.
 
@@ -458,6 +1388,7 @@ def batch_get_values(sheet_service: Resource, ss_id: str, range_names: list[str]
         sheet_service (Resource): The authenticated sheet service instance
         ss_id (str): The ID of the spreadsheet to return
         range_names (list[str]): A list containing all the ranges to retrieve
+        http (httplib2.Http): The connection to use instead of the service's, see new_http
 
     Returns:
         dict: An object containing the values of the specified ranges
@@ -466,10 +1397,10 @@ def batch_get_values(sheet_service: Resource, ss_id: str, range_names: list[str]
         Exception: If an error occured.
     """
   try:
-    result = sheet_service.spreadsheets().values().batchGet(
+    result = execute(sheet_service.spreadsheets().values().batchGet(
         spreadsheetId=ss_id, 
         ranges=range_names
-    ).execute()
+    ), http=http)
     ranges = result.get("valueRanges", [])
     print(f"{len(ranges)} ranges retrieved")
     return ranges
@@ -477,13 +1408,14 @@ def batch_get_values(sheet_service: Resource, ss_id: str, range_names: list[str]
     print(f"An error occurred: {error}")
     return None
   
-def get_items_from_drive(drive_service: Resource, query: str) -> list[dict]:
+def get_items_from_drive(drive_service: Resource, query: str, fields: str | list[str] = FILE_FIELDS) -> list[dict]:
     """
     Queries the Google Drive Resource and return a list of items that match the given query
 
     Args:
         drive_service (Resource): The authenticated drive service instance
         query (str): A query for filtering the file results
+        fields (str | list[str]): The fields to return per item, e.g. "id,name,modifiedTime" or "*" for all of them
 
     Returns:
         list[dict]: A list with all the File Resources that matched the given query
@@ -493,32 +1425,422 @@ def get_items_from_drive(drive_service: Resource, query: str) -> list[dict]:
     """
     print("Getting items from Google Drive")
     try:
-        items_list = []
-        pageToken = None
-
-        while True:
-            request = drive_service.files().list(
-                includeItemsFromAllDrives = True, 
-                supportsAllDrives = True, 
-                pageToken = pageToken,
-                pageSize = 500,
-                q = query, 
-                fields = "files(id,name,mimeType,modifiedTime,createdTime,permissionIds,shortcutDetails),nextPageToken"
-            ).execute()
-            # print(request)
-            items = request.get('files', [])
-            items_list = items_list + items
-            
-            pageToken = request.get("nextPageToken", None)
-            if not pageToken:
-                break
+        # Nothing is done between pages here, so there is nothing to overlap the prefetch with
+        items_list = list(iter_items_from_drive(drive_service, query, prefetch=False, fields=fields))
             
         print(f"{len(items_list)} items matching the given query")
         return items_list
     except Exception as e:
         print(f'An error occurred: {e}')
         return []
-    
+
+def iter_items_from_drive(drive_service: Resource, query: str, page_size: int = 500, prefetch: bool = True, http: httplib2.Http = None, fields: str | list[str] = FILE_FIELDS):
+    """
+    Queries the Google Drive Resource and yields the items that match the given query, one page at a time.
+    With prefetch, the next page is requested on a background thread while the caller works through the current one,
+    so at most two pages are held in memory.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        query (str): A query for filtering the file results
+        page_size (int): The number of items to request per page
+        prefetch (bool): Request the next page while the current one is being processed
+        http (httplib2.Http): The connection to use instead of the service's when not prefetching, see new_http
+        fields (str | list[str]): The fields to return per item, e.g. "id,name,modifiedTime" or "*" for all of them
+
+    Yields:
+        dict: The File Resources that match the given query
+
+    Raises:
+        Exception: If an error occured.
+
+    Example:
+        for item in iter_items_from_drive(drive_service, f"'{folder_id}' in parents"):
+            print(item["name"])
+    """
+    def list_request(page_token):
+        return drive_service.files().list(
+            includeItemsFromAllDrives = True, 
+            supportsAllDrives = True, 
+            pageToken = page_token,
+            pageSize = page_size,
+            q = query, 
+            fields = get_fields_mask(fields, "files")
+        )
+
+    if not prefetch:
+        page_token = None
+        while True:
+            response = execute(list_request(page_token), http=http)
+            yield from response.get('files', [])
+
+            page_token = response.get("nextPageToken", None)
+            if not page_token:
+                return
+
+    # The service's connection isn't thread safe, so the background thread gets its own
+    pool = ServicePool.from_service(drive_service)
+
+    def get_page(page_token):
+        return execute(list_request(page_token), http=pool.get_http())
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = None
+    try:
+        future = executor.submit(get_page, None)
+        while True:
+            response = future.result()
+
+            page_token = response.get("nextPageToken", None)
+            if page_token:
+                future = executor.submit(get_page, page_token)
+
+            yield from response.get('files', [])
+
+            if not page_token:
+                return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        # Closed once the page being prefetched, if any, is in, also when the caller stops early
+        if future is None:
+            pool.close()
+        else:
+            future.add_done_callback(lambda _: pool.close())
+
+def open_drive_index(index_path: str) -> sqlite3.Connection:
+    """
+    Opens the SQLite drive index, creating its tables if needed, see crawl_drive_tree.
+
+    The index has the tables:
+        items: id, name, mimeType, modifiedTime and permissionIds (comma separated) of every item
+        parents: id and parent_id, one row per parent of an item
+        meta: key and value, e.g. the root_id of the crawl and the start_page_token of the Changes API, see sync_drive_index
+
+    Args:
+        index_path (str): The SQLite file of the index
+
+    Returns:
+        sqlite3.Connection: The connection to the index
+    """
+    path = os.path.dirname(index_path)
+    if path and not os.path.exists(path):
+        os.makedirs(path)
+
+    connection = sqlite3.connect(index_path)
+    connection.row_factory = sqlite3.Row
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, name TEXT, mimeType TEXT, modifiedTime TEXT, permissionIds TEXT);
+        CREATE TABLE IF NOT EXISTS parents (id TEXT, parent_id TEXT, PRIMARY KEY (id, parent_id));
+        CREATE INDEX IF NOT EXISTS parents_parent_id ON parents (parent_id);
+        CREATE INDEX IF NOT EXISTS items_name ON items (name);
+        CREATE INDEX IF NOT EXISTS items_mime_type ON items (mimeType);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+    """)
+    return connection
+
+def crawl_drive_tree(drive_service: Resource, root_id: str, index_path: str, max_workers: int = 8) -> dict:
+    """
+    Walks the folder tree under root_id breadth first and writes every item to a SQLite index,
+    so later questions about the tree can be answered with query_drive_index instead of API calls.
+    Many folders are listed at the same time, the index replaces any earlier crawl.
+
+    Shortcuts are indexed but not followed, and trashed items are left out.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        root_id (str): The id of the folder or shared drive to crawl
+        index_path (str): The SQLite file of the index, see open_drive_index
+        max_workers (int): The number of folders to list at the same time
+
+    Returns:
+        dict: A summary of the crawl
+            'folders': The number of folders listed
+            'items': The number of items written
+            'errors': The error message by folder id, for the folders that failed
+
+    Raises:
+        Exception: If an error occured.
+
+    Example:
+        crawl_drive_tree(drive_service, folder_id, 'index.db')
+        pdfs = query_drive_index('index.db', under=folder_id, mime_type='application/pdf')
+    """
+    print(f"Crawling the drive tree under {root_id}")
+    # Taken before the crawl, so changes made during it are picked up by the next sync
+    start_page_token = execute(drive_service.changes().getStartPageToken(supportsAllDrives=True))["startPageToken"]
+    root = execute(drive_service.files().get(
+        fileId=root_id,
+        supportsAllDrives=True,
+        fields=INDEX_FIELDS
+    ))
+
+    errors = {}
+    pool = ServicePool.from_service(drive_service)
+
+    def list_folder(folder_id):
+        query = f"'{folder_id}' in parents and trashed = false"
+        return list(iter_items_from_drive(drive_service, query, page_size=1000, prefetch=False, http=pool.get_http(), fields=INDEX_FIELDS))
+
+    connection = open_drive_index(index_path)
+    try:
+        connection.execute("DELETE FROM items")
+        connection.execute("DELETE FROM parents")
+        connection.execute("DELETE FROM meta")
+        connection.execute("INSERT INTO items VALUES (?, ?, ?, ?, ?)", get_index_row(root))
+
+        seen = {root_id}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(list_folder, root_id): root_id}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder_id = pending.pop(future)
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        print(f"Error listing folder {folder_id}: {e}")
+                        errors[folder_id] = str(e)
+                        continue
+
+                    # Only the main thread writes, a SQLite connection can't be shared between threads
+                    connection.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)", [get_index_row(item) for item in items])
+                    connection.executemany("INSERT OR IGNORE INTO parents VALUES (?, ?)", [(item['id'], folder_id) for item in items])
+
+                    for item in items:
+                        # A folder with several parents in the tree is only listed once
+                        if item.get('mimeType') == FOLDER_MIME_TYPE and item['id'] not in seen:
+                            seen.add(item['id'])
+                            pending[executor.submit(list_folder, item['id'])] = item['id']
+
+        connection.executemany("INSERT INTO meta VALUES (?, ?)", [("root_id", root_id), ("start_page_token", start_page_token)])
+        connection.commit()
+        count = connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+    finally:
+        pool.close()
+        connection.close()
+
+    print(f"{count} items in {len(seen)} folders written to {index_path}")
+    return {'folders': len(seen), 'items': count, 'errors': errors}
+
+def sync_drive_index(drive_service: Resource, index_path: str, root_id: str = None, max_workers: int = 8) -> dict:
+    """
+    Brings the drive index up to date with the changes made since the last crawl or sync, see crawl_drive_tree.
+    Only the Changes API deltas are fetched, so a refresh costs a few requests instead of a full crawl.
+
+    A full crawl is done instead if the index has no watermark yet, or if the Changes API no longer accepts it.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        index_path (str): The SQLite file of the index, see open_drive_index
+        root_id (str): The folder to crawl if the index is empty, defaults to the root of the last crawl
+        max_workers (int): The number of folders to list at the same time during a full crawl
+
+    Returns:
+        dict: A summary of the sync
+            'changes': The number of changes read
+            'updated': The number of items added or updated
+            'removed': The number of items removed
+        or the summary of crawl_drive_tree if a full crawl was done
+
+    Raises:
+        Exception: If an error occured.
+    """
+    connection = open_drive_index(index_path)
+    try:
+        meta = {row['key']: row['value'] for row in connection.execute("SELECT key, value FROM meta")}
+        root_id = meta.get('root_id', root_id)
+        page_token = meta.get('start_page_token')
+        if not page_token:
+            connection.close()
+            return crawl_drive_tree(drive_service, root_id, index_path, max_workers)
+
+        print(f"Syncing {index_path} from page token {page_token}")
+        changes = updated = removed = 0
+        while True:
+            try:
+                response = execute(drive_service.changes().list(
+                    pageToken=page_token,
+                    pageSize=1000,
+                    includeRemoved=True,
+                    includeItemsFromAllDrives=True,
+                    supportsAllDrives=True,
+                    fields=f"nextPageToken,newStartPageToken,changes(changeType,fileId,removed,file({INDEX_FIELDS},parents,trashed))"
+                ))
+            except HttpError as e:
+                if e.resp.status not in (400, 404):
+                    raise
+                # The watermark expired, closing without a commit discards the changes applied so far
+                print(f"The page token is no longer valid, crawling {root_id} again: {e}")
+                connection.close()
+                return crawl_drive_tree(drive_service, root_id, index_path, max_workers)
+
+            for change in response.get('changes', []):
+                changes += 1
+                # Changes to shared drives themselves have no fileId, they don't touch the index
+                if change.get('changeType', "file") != "file" or not change.get('fileId'):
+                    continue
+                file = change.get('file') or {}
+                if change.get('removed') or file.get('trashed'):
+                    removed += remove_from_index(connection, change['fileId'])
+                elif not file:
+                    # Without its metadata the file can't be placed in the tree
+                    continue
+                elif file['id'] == root_id:
+                    connection.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)", get_index_row(file))
+                    updated += 1
+                else:
+                    parents = [row[0] for row in connection.execute(
+                        f"SELECT id FROM items WHERE id IN ({', '.join('?' * len(file.get('parents', [])))})", file.get('parents', [])
+                    )]
+                    if not parents:
+                        # Not, or no longer, inside the indexed tree
+                        removed += remove_from_index(connection, file['id'])
+                        continue
+
+                    is_new = connection.execute("SELECT 1 FROM items WHERE id = ?", (file['id'],)).fetchone() is None
+                    connection.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)", get_index_row(file))
+                    connection.execute("DELETE FROM parents WHERE id = ?", (file['id'],))
+                    connection.executemany("INSERT INTO parents VALUES (?, ?)", [(file['id'], parent) for parent in parents])
+                    updated += 1
+
+                    # A folder moved into the tree brings along items the index has never seen
+                    if is_new and file.get('mimeType') == FOLDER_MIME_TYPE:
+                        updated += index_subtree(drive_service, connection, file['id'])
+
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+
+        connection.execute("INSERT OR REPLACE INTO meta VALUES ('start_page_token', ?)", (response['newStartPageToken'],))
+        connection.commit()
+    finally:
+        connection.close()
+
+    print(f"{changes} changes applied to {index_path}: {updated} updated, {removed} removed")
+    return {'changes': changes, 'updated': updated, 'removed': removed}
+
+def remove_from_index(connection: sqlite3.Connection, item_id: str) -> int:
+    """
+    Removes an item and everything below it from the drive index.
+    Anything below that is also inside another indexed folder is kept.
+
+    Args:
+        connection (sqlite3.Connection): The connection to the index, see open_drive_index
+        item_id (str): The id of the item
+
+    Returns:
+        int: The number of items removed
+    """
+    removed = 0
+    pending = [item_id]
+    while pending:
+        item_id = pending.pop()
+        removed += connection.execute("DELETE FROM items WHERE id = ?", (item_id,)).rowcount
+        connection.execute("DELETE FROM parents WHERE id = ?", (item_id,))
+
+        children = [row[0] for row in connection.execute("SELECT id FROM parents WHERE parent_id = ?", (item_id,))]
+        connection.execute("DELETE FROM parents WHERE parent_id = ?", (item_id,))
+        for child in children:
+            if connection.execute("SELECT 1 FROM parents WHERE id = ?", (child,)).fetchone() is None:
+                pending.append(child)
+    return removed
+
+def index_subtree(drive_service: Resource, connection: sqlite3.Connection, folder_id: str) -> int:
+    """
+    Lists everything below a folder and adds it to the drive index, one folder at a time.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        connection (sqlite3.Connection): The connection to the index, see open_drive_index
+        folder_id (str): The id of the folder, which is already in the index
+
+    Returns:
+        int: The number of items added or updated
+    """
+    count = 0
+    pending = [folder_id]
+    while pending:
+        folder_id = pending.pop(0)
+        items = list(iter_items_from_drive(drive_service, f"'{folder_id}' in parents and trashed = false", page_size=1000, prefetch=False, fields=INDEX_FIELDS))
+        for item in items:
+            is_new = connection.execute("SELECT 1 FROM items WHERE id = ?", (item['id'],)).fetchone() is None
+            connection.execute("INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?)", get_index_row(item))
+            connection.execute("INSERT OR IGNORE INTO parents VALUES (?, ?)", (item['id'], folder_id))
+            if is_new and item.get('mimeType') == FOLDER_MIME_TYPE:
+                pending.append(item['id'])
+        count += len(items)
+    return count
+
+def get_index_row(item: dict) -> tuple:
+    """
+    Returns a File Resource as a row of the items table of the drive index, see open_drive_index.
+
+    Args:
+        item (dict): The File Resource
+
+    Returns:
+        tuple: The row
+    """
+    return (
+        item['id'],
+        item.get('name'),
+        item.get('mimeType'),
+        item.get('modifiedTime'),
+        ",".join(item.get('permissionIds', []))
+    )
+
+def query_drive_index(index_path: str, under: str = None, name: str = None, mime_type: str = None) -> list[dict]:
+    """
+    Queries the drive index written by crawl_drive_tree, without calling the API.
+
+    Args:
+        index_path (str): The SQLite file of the index
+        under (str): Only return the items anywhere below this folder
+        name (str): Only return the items with this name, % and _ work as wildcards
+        mime_type (str): Only return the items with this mime type
+
+    Returns:
+        list[dict]: The matching items, with their parents as a list of ids
+
+    Example:
+        folders = query_drive_index('index.db', name='Invoices', mime_type=FOLDER_MIME_TYPE)
+    """
+    conditions = []
+    params = []
+    query = "SELECT items.*, (SELECT GROUP_CONCAT(parent_id) FROM parents WHERE parents.id = items.id) AS parents FROM items"
+
+    if under:
+        # Walks down the parents table from the given folder
+        query = """
+            WITH RECURSIVE tree(id) AS (
+                SELECT id FROM parents WHERE parent_id = ?
+                UNION
+                SELECT parents.id FROM parents JOIN tree ON parents.parent_id = tree.id
+            )
+        """ + query
+        params.append(under)
+        conditions.append("items.id IN tree")
+    if name:
+        conditions.append("items.name LIKE ?")
+        params.append(name)
+    if mime_type:
+        conditions.append("items.mimeType = ?")
+        params.append(mime_type)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    connection = open_drive_index(index_path)
+    try:
+        items = []
+        for row in connection.execute(query, params):
+            item = dict(row)
+            item['permissionIds'] = item['permissionIds'].split(",") if item['permissionIds'] else []
+            item['parents'] = item['parents'].split(",") if item['parents'] else []
+            items.append(item)
+        return items
+    finally:
+        connection.close()
+
 def create_spreadsheet(drive_service: Resource, folder_id: str, sheet_name: str) -> dict:
     """
     Creates a new Google Sheet and returns its ID.
@@ -536,11 +1858,11 @@ def create_spreadsheet(drive_service: Resource, folder_id: str, sheet_name: str)
     """
     print("Creating a new Google Sheet")
     try:
-        sheet = drive_service.files().create(body={
+        sheet = execute(drive_service.files().create(body={
             'name': sheet_name,
             'mimeType': 'application/vnd.google-apps.spreadsheet',
             "parents": [folder_id],
-        }).execute()
+        }))
         print(f"Sheet ID: {sheet.get('id')}")
         return sheet
     except Exception as e:
@@ -564,6 +1886,7 @@ def get_credentials(path_to_creds: str, scopes: list[str], user: str = None) ->
     """
     print("Getting credentials")
     try:
+        from google.oauth2 import service_account
         credentials = service_account.Credentials.from_service_account_file(
             path_to_creds, 
             scopes=scopes
@@ -597,13 +1920,204 @@ def create_service(api_name: str, api_version: str, credentials: service_account
         service = create_service('drive', 'v3', credentials)
     """
     try:
+        from googleapiclient.discovery import build, build_from_document
+        document = get_discovery_document(api_name, api_version)
+        if document is None:
+            # Not bundled with googleapiclient, so let build fetch it
+            return build(api_name, api_version, credentials=credentials)
+
         # Build the service
-        service = build(api_name, api_version, credentials=credentials)
+        service = build_from_document(document, credentials=credentials)
         return service
     except Exception as e:
         print(f'An error occurred: {e}')
         return None
 
+def get_discovery_document(api_name: str, api_version: str) -> dict:
+    """
+    Returns the parsed discovery document of an API from the documents bundled with googleapiclient.
+
+    Args:
+        api_name (str): The name of the API (e.g., 'drive').
+        api_version (str): The version of the API (e.g., 'v3').
+
+    Returns:
+        dict: The discovery document, or None if it isn't bundled
+    """
+    import httplib2
+    from googleapiclient import discovery_cache
+    from googleapiclient.discovery import build_from_document
+
+    key = (api_name, api_version)
+    with _discovery_lock:
+        if key not in _discovery_documents:
+            document = None
+            content = discovery_cache.get_static_doc(api_name, api_version)
+            if content is not None:
+                document = json.loads(content)
+                # Building a resource fills in defaults on the document the first time it is used.
+                # Doing that for every resource now keeps the shared document unchanged once other threads use it.
+                load_resources(build_from_document(document, http=httplib2.Http()), document)
+            _discovery_documents[key] = document
+        return _discovery_documents[key]
+
+def load_resources(resource: Resource, description: dict):
+    """
+    Creates every nested resource of a service, see get_discovery_document.
+
+    Args:
+        resource (Resource): The service or resource instance
+        description (dict): The part of the discovery document describing the resource
+    """
+    for name, nested_description in description.get("resources", {}).items():
+        load_resources(getattr(resource, name)(), nested_description)
+
+class ServicePool:
+    """
+    Hands out a service per thread for one API, for helpers that run on many threads at once.
+
+    A service's connection isn't thread safe, so every thread gets its own service and connection, which is kept alive
+    and reused for every call the thread makes. All of them share the credentials and the parsed discovery document,
+    so only the first service pays for discovery, and an expired token is refreshed once instead of by every thread.
+
+    Helpers that are given a service use ServicePool.from_service, and pass get_http to execute(http=...).
+
+    Example:
+        pool = ServicePool('drive', 'v3', credentials)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            files = list(executor.map(lambda file_id: get_file(pool.get(), file_id), file_ids))
+        pool.close()
+    """
+
+    def __init__(self, api_name: str, api_version: str, credentials: service_account.Credentials, document: dict = None):
+        self.api_name = api_name
+        self.api_version = api_version
+        # None for a service without credentials, e.g. one that calls a local fake of the API
+        self.credentials = lock_credentials_refresh(credentials) if credentials is not None else None
+        # The discovery document to build services from, instead of the one of the API
+        self.document = document
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_service(cls, service: Resource) -> ServicePool:
+        """Returns a pool for the API of the given service, with its credentials and discovery document."""
+        import google_auth_httplib2
+
+        # A plain httplib2.Http also has a credentials attribute, for basic auth, so only authorized ones are copied
+        credentials = service._http.credentials if isinstance(service._http, google_auth_httplib2.AuthorizedHttp) else None
+        return cls(service._rootDesc.get('name'), service._rootDesc.get('version'), credentials, document=service._rootDesc)
+
+    def get_http(self) -> httplib2.Http:
+        """Returns the connection of the current thread, creating it on the first call."""
+        http = getattr(self.local, "http", None)
+        if http is None:
+            import httplib2
+            import google_auth_httplib2
+
+            http = httplib2.Http()
+            with self.lock:
+                self.connections.append(http)
+            if self.credentials is not None:
+                http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+            self.local.http = http
+        return http
+
+    def get(self) -> Resource:
+        """Returns the service of the current thread, creating it on the first call."""
+        service = getattr(self.local, "service", None)
+        if service is None:
+            from googleapiclient.discovery import build, build_from_document
+
+            http = self.get_http()
+            document = self.document or get_discovery_document(self.api_name, self.api_version)
+            if document is None:
+                service = build(self.api_name, self.api_version, http=http)
+            else:
+                service = build_from_document(document, http=http)
+            self.local.service = service
+        return service
+
+    def close(self):
+        """Closes the connections of all threads. Services handed out before can't be used afterwards."""
+        with self.lock:
+            for http in self.connections:
+                for connection in list(http.connections.values()):
+                    connection.close()
+                http.connections.clear()
+            self.connections = []
+        self.local = threading.local()
+
+def lock_credentials_refresh(credentials: service_account.Credentials) -> service_account.Credentials:
+    """
+    Makes refreshing the credentials safe when they are shared between threads.
+    Only one thread refreshes at a time, and threads that waited for it use the new token instead of refreshing again.
+
+    Args:
+        credentials (Credentials): The credentials, changed in place
+
+    Returns:
+        Credentials: The same credentials
+    """
+    if getattr(credentials, "_refresh_lock", None) is not None:
+        return credentials
+
+    lock = threading.Lock()
+    refresh = credentials.refresh
+
+    def locked_refresh(request):
+        token = credentials.token
+        with lock:
+            if credentials.token != token and credentials.valid:
+                # Another thread refreshed it while this one waited
+                return
+            refresh(request)
+
+    credentials._refresh_lock = lock
+    credentials.refresh = locked_refresh
+    return credentials
+
+def new_http(service: Resource) -> httplib2.Http:
+    """
+    Returns a new http connection that uses the same credentials as the given service.
+    A service's connection isn't thread safe, pass this to execute(http=...) to use the service from another thread.
+
+    Args:
+        service (Resource): The authenticated service instance
+
+    Returns:
+        httplib2.Http: The new http connection
+    """
+    import httplib2
+    import google_auth_httplib2
+
+    # A plain httplib2.Http also has a credentials attribute, for basic auth, so only authorized ones are copied
+    if not isinstance(service._http, google_auth_httplib2.AuthorizedHttp):
+        return httplib2.Http()
+    # The new connection shares the credentials with the service
+    return google_auth_httplib2.AuthorizedHttp(lock_credentials_refresh(service._http.credentials), http=httplib2.Http())
+
+def get_fields_mask(fields: str | list[str], collection: str = None) -> str:
+    """
+    Returns the fields parameter of a request for the given fields.
+
+    Args:
+        fields (str | list[str]): The fields, e.g. "id,name" or ["id", "name"]
+        collection (str): The list the items are returned in, e.g. 'files', if the request returns pages of items
+
+    Returns:
+        str: The fields mask, e.g. "nextPageToken,files(id,name)"
+
+    Example:
+        get_fields_mask(["id", "name"], "files") returns 'nextPageToken,files(id,name)'
+    """
+    if not isinstance(fields, str):
+        fields = ",".join(fields)
+    if collection is None:
+        return fields
+    return f"nextPageToken,{collection}({fields})"
+
 def get_id_from_url(url: str) -> str:
     """
     Returns the ID for the Google File or Folder from the given URL.
@@ -0,0 +1,620 @@
+"""
+asyncio versions of the Drive and Sheets helpers of google_services.
+
+Every call goes through an AsyncGoogleClient, which holds one aiohttp session (and so one pool of keep-alive
+connections) and a limit on the number of calls in flight. A single process can keep hundreds of calls going
+without a thread and an httplib2 connection for each of them.
+
+Example:
+    async with AsyncGoogleClient(credentials) as client:
+        files = await get_items_from_drive(client, f"'{folder_id}' in parents")
+        contents = await asyncio.gather(*(download_file(client, file['id']) for file in files))
+"""
+from __future__ import annotations
+
+import os
+import io
+import json
+import uuid
+import random
+import asyncio
+
+import aiohttp
+
+from urllib.parse import quote
+
+from typing import BinaryIO, Mapping, TYPE_CHECKING
+
+from google_services import (
+    FILE_FIELDS,
+    PERMISSION_FIELDS,
+    RETRYABLE_STATUSES,
+    RATE_LIMIT_REASONS,
+    get_api_name,
+    get_fields_mask,
+    get_rate_limiter,
+    lock_credentials_refresh,
+)
+
+if TYPE_CHECKING:
+    from google.oauth2 import service_account
+
+# The endpoints of the APIs, can be pointed at another server, e.g. a local fake for benchmarks
+DRIVE_URL = os.environ.get("GOOGLE_DRIVE_URL", "https://www.googleapis.com/drive/v3")
+DRIVE_UPLOAD_URL = os.environ.get("GOOGLE_DRIVE_UPLOAD_URL", "https://www.googleapis.com/upload/drive/v3")
+SHEETS_URL = os.environ.get("GOOGLE_SHEETS_URL", "https://sheets.googleapis.com/v4")
+
+# The most calls an AsyncGoogleClient has in flight at the same time, can be overridden per client
+MAX_CONCURRENCY = int(os.environ.get("GOOGLE_ASYNC_MAX_CONCURRENCY", "100"))
+
+# Uploads and downloads are sent and written in chunks of this size, uploads need a multiple of 256 KiB
+CHUNK_SIZE = int(os.environ.get("GOOGLE_ASYNC_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+class GoogleApiError(Exception):
+    """
+    An error response from a Google API.
+
+    Attributes:
+        status (int): The HTTP status of the response
+        reason (str): The reason given by the API, e.g. 'rateLimitExceeded'
+        retry_after (float): The seconds the API asked to wait before retrying, or None
+    """
+
+    def __init__(self, method: str, url: str, status: int, message: str, reason: str = None, retry_after: float = None):
+        super().__init__(f"{status} when requesting {method} {url}: {message}")
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def is_rate_limit(self) -> bool:
+        return self.status == 429 or self.reason in RATE_LIMIT_REASONS
+
+    @property
+    def is_retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUSES or self.is_rate_limit
+
+class AsyncGoogleClient:
+    """
+    Sends calls to the Google APIs from asyncio code.
+
+    All calls share one aiohttp session with at most max_concurrency connections and calls in flight. They go through
+    the same per-API rate limiters as google_services, and rate limit and server errors are retried with backoff.
+    The credentials are refreshed once when they expire, not by every call that notices.
+
+    Example:
+        async with AsyncGoogleClient(credentials, max_concurrency=200) as client:
+            file = await get_file(client, file_id)
+    """
+
+    def __init__(self, credentials: service_account.Credentials | str, max_concurrency: int = MAX_CONCURRENCY, timeout: float = 300):
+        # An access token is used as is, like pdf_protecting does with the token it is given
+        self.token = credentials if isinstance(credentials, str) else None
+        self.credentials = None if isinstance(credentials, str) else lock_credentials_refresh(credentials)
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+        self.refresh_lock = None
+
+    async def __aenter__(self) -> AsyncGoogleClient:
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Creates the session, called by the first call if it wasn't opened before."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_concurrency)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+            self.refresh_lock = asyncio.Lock()
+
+    async def close(self):
+        """Closes the session and its connections."""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_token(self) -> str:
+        """Returns a valid access token, refreshing the credentials if needed."""
+        if self.credentials is None:
+            return self.token
+        if not self.credentials.valid:
+            async with self.refresh_lock:
+                if not self.credentials.valid:
+                    from google.auth.transport.requests import Request
+                    # Refreshing blocks, so it runs on a thread instead of the event loop
+                    await asyncio.get_running_loop().run_in_executor(None, self.credentials.refresh, Request())
+        return self.credentials.token
+
+    async def send(self, method: str, url: str, params: dict | list = None, json_body: dict = None, data: bytes = None, headers: dict = None, destination: BinaryIO = None, max_retries: int = 5) -> tuple[int, Mapping[str, str], bytes]:
+        """
+        Sends a call, waiting for a free slot and the rate limiter of its API first.
+
+        Args:
+            method (str): The HTTP method
+            url (str): The url of the call
+            params (dict | list): The query parameters, as a list of pairs to repeat a parameter
+            json_body (dict): The body to send as JSON
+            data (bytes): The body to send as is
+            headers (dict): Extra headers
+            destination (BinaryIO): Write a successful response's body here in chunks instead of returning it
+            max_retries (int): How many times the call is retried on rate limit and server errors
+
+        Returns:
+            tuple[int, Mapping[str, str], bytes]: The status, headers and body of the response. The body is empty with a destination.
+                The headers are looked up case-insensitively, e.g. "location" finds "Location"
+
+        Raises:
+            GoogleApiError: If the API returned an error, after the retries for the retryable ones.
+        """
+        await self.open()
+        rate_limiter = get_rate_limiter(get_api_name(url))
+        start = destination.tell() if destination is not None else None
+
+        for attempt in range(max_retries + 1):
+            while (wait_time := rate_limiter.try_acquire()) > 0:
+                await asyncio.sleep(wait_time)
+
+            request_headers = {"Authorization": f"Bearer {await self.get_token()}", **(headers or {})}
+            try:
+                async with self.semaphore:
+                    async with self.session.request(method, url, params=params, json=json_body, data=data, headers=request_headers) as response:
+                        if response.status < 300 or response.status == 308:
+                            if destination is None:
+                                body = await response.read()
+                            else:
+                                body = b""
+                                # A retry starts the file over
+                                destination.seek(start)
+                                destination.truncate()
+                                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                                    destination.write(chunk)
+                            rate_limiter.on_success()
+                            # The CIMultiDictProxy of aiohttp, as a dict would make header lookups case-sensitive
+                            return response.status, response.headers, body
+
+                        error = get_api_error(method, url, response.status, response.headers, await response.read())
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == max_retries:
+                    raise
+                error = e
+            else:
+                if error.status == 401 and self.credentials is not None and attempt < max_retries:
+                    # The token was revoked or expired early, the next attempt gets a new one
+                    self.credentials.token = None
+                    continue
+                if not error.is_retryable or attempt == max_retries:
+                    raise error
+                if error.is_rate_limit:
+                    rate_limiter.on_rate_limited(error.retry_after)
+
+            wait_time = (2 ** attempt) * 0.5 + random.random()
+            print(f"{error}. Retrying in {wait_time:.1f} seconds...")
+            await asyncio.sleep(wait_time)
+
+    async def request(self, method: str, url: str, params: dict | list = None, json_body: dict = None, headers: dict = None) -> dict:
+        """Sends a call and returns its JSON response, see send."""
+        status, response_headers, body = await self.send(method, url, params=params, json_body=json_body, headers=headers)
+        return json.loads(body) if body else {}
+
+def get_api_error(method: str, url: str, status: int, headers: dict, body: bytes) -> GoogleApiError:
+    """
+    Returns the error of a failed call.
+
+    Args:
+        method (str): The HTTP method of the call
+        url (str): The url of the call
+        status (int): The status of the response
+        headers (dict): The headers of the response
+        body (bytes): The body of the response
+
+    Returns:
+        GoogleApiError: The error
+    """
+    message = body.decode("utf-8", errors="replace")
+    reason = None
+    try:
+        error = json.loads(body).get("error", {})
+        message = error.get("message", message)
+        details = error.get("errors") or []
+        reason = details[0].get("reason") if details else error.get("status")
+    except (ValueError, AttributeError):
+        pass
+
+    retry_after = headers.get("Retry-After")
+    try:
+        retry_after = float(retry_after) if retry_after else None
+    except ValueError:
+        retry_after = None
+    return GoogleApiError(method, url, status, message, reason, retry_after)
+
+async def get_items_from_drive(client: AsyncGoogleClient, query: str, fields: str | list[str] = FILE_FIELDS) -> list[dict]:
+    """
+    Queries the Google Drive Resource and return a list of items that match the given query
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        query (str): A query for filtering the file results
+        fields (str | list[str]): The fields to return per item, e.g. "id,name,modifiedTime" or "*" for all of them
+
+    Returns:
+        list[dict]: A list with all the File Resources that matched the given query
+
+    Raises:
+        Exception: If an error occured.
+    """
+    print("Getting items from Google Drive")
+    try:
+        items_list = [item async for item in iter_items_from_drive(client, query, fields=fields)]
+
+        print(f"{len(items_list)} items matching the given query")
+        return items_list
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return []
+
+async def iter_items_from_drive(client: AsyncGoogleClient, query: str, page_size: int = 500, fields: str | list[str] = FILE_FIELDS):
+    """
+    Queries the Google Drive Resource and yields the items that match the given query, one page at a time.
+    The next page is requested while the caller works through the current one.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        query (str): A query for filtering the file results
+        page_size (int): The number of items to request per page
+        fields (str | list[str]): The fields to return per item, e.g. "id,name,modifiedTime" or "*" for all of them
+
+    Yields:
+        dict: The File Resources that match the given query
+
+    Raises:
+        Exception: If an error occured.
+
+    Example:
+        async for item in iter_items_from_drive(client, f"'{folder_id}' in parents"):
+            print(item["name"])
+    """
+    def list_request(page_token):
+        params = {
+            "includeItemsFromAllDrives": "true",
+            "supportsAllDrives": "true",
+            "pageSize": page_size,
+            "q": query,
+            "fields": get_fields_mask(fields, "files")
+        }
+        if page_token:
+            params["pageToken"] = page_token
+        return asyncio.ensure_future(client.request("GET", f"{DRIVE_URL}/files", params=params))
+
+    task = list_request(None)
+    try:
+        while True:
+            response = await task
+
+            page_token = response.get("nextPageToken", None)
+            if page_token:
+                task = list_request(page_token)
+
+            for item in response.get('files', []):
+                yield item
+
+            if not page_token:
+                return
+    finally:
+        task.cancel()
+
+async def get_file(client: AsyncGoogleClient, file_id: str, fields: str | list[str] = FILE_FIELDS) -> dict:
+    """
+    Returns the file with the given id.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        file_id (str): The id of the file
+        fields (str | list[str]): The fields to return, e.g. "id,name,md5Checksum,size" or "*" for all of them
+
+    Returns:
+        dict: The File Resource of the file
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        return await client.request("GET", f"{DRIVE_URL}/files/{file_id}", params={
+            "supportsAllDrives": "true",
+            "fields": get_fields_mask(fields)
+        })
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+async def download_file(client: AsyncGoogleClient, file_id: str, destination: BinaryIO = None) -> BinaryIO:
+    """
+    Downloads the contents of a file from Google Drive.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        file_id (str): The id of the file to download
+        destination (BinaryIO): The stream to write the contents to as they come in, a new BytesIO if not given
+
+    Returns:
+        BinaryIO: The stream with the contents, positioned at its start
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        file_stream = destination if destination is not None else io.BytesIO()
+        start = file_stream.tell()
+        await client.send("GET", f"{DRIVE_URL}/files/{file_id}", params={"alt": "media", "supportsAllDrives": "true"}, destination=file_stream)
+        file_stream.seek(start)
+        return file_stream
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+async def upload_file_to_drive(client: AsyncGoogleClient, content: bytes | BinaryIO, filename: str, parent_folder_id: str = None, mimetype: str = "application/pdf", fields: str | list[str] = FILE_FIELDS) -> dict:
+    """
+    Uploads a file to Google Drive.
+    Contents up to CHUNK_SIZE are sent in one call, larger ones and streams in chunks of CHUNK_SIZE.
+    After a failed chunk, the upload resumes from the bytes Drive reports it stored.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        content (bytes | BinaryIO): The contents of the file
+        filename (str): The name of the new file
+        parent_folder_id (str): The id of the drive folder to save the file in
+        mimetype (str): The mime type of the contents
+        fields (str | list[str]): The fields of the new file to return
+
+    Returns:
+        dict: The File Resource of the new file
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        file_metadata = {"name": filename}
+        if parent_folder_id:
+            file_metadata["parents"] = [parent_folder_id]
+        params = {"supportsAllDrives": "true", "fields": get_fields_mask(fields)}
+
+        if isinstance(content, bytes) and len(content) <= CHUNK_SIZE:
+            boundary = uuid.uuid4().hex
+            body = b"".join([
+                f"--{boundary}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".encode(),
+                json.dumps(file_metadata).encode(),
+                f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n\r\n".encode(),
+                content,
+                f"\r\n--{boundary}--".encode()
+            ])
+            status, headers, response = await client.send(
+                "POST", f"{DRIVE_UPLOAD_URL}/files", params={**params, "uploadType": "multipart"},
+                data=body, headers={"Content-Type": f"multipart/related; boundary={boundary}"}
+            )
+            return json.loads(response)
+
+        # Resumable upload: a session is started with the metadata, then the contents are sent in chunks
+        status, headers, response = await client.send(
+            "POST", f"{DRIVE_UPLOAD_URL}/files", params={**params, "uploadType": "resumable"},
+            json_body=file_metadata, headers={"X-Upload-Content-Type": mimetype}
+        )
+        session_url = headers["Location"]
+
+        stream = io.BytesIO(content) if isinstance(content, bytes) else content
+        # The contents read from the stream that Drive hasn't stored yet. They are kept until Drive has them,
+        # as a failed chunk has to be sent again and not every stream can seek back to it
+        pending = b""
+        offset = 0
+        end_of_stream = False
+        failures = 0
+        while True:
+            # Reading past the chunk tells whether it is the last one, which has to carry the total size
+            while not end_of_stream and len(pending) <= CHUNK_SIZE:
+                data = stream.read(CHUNK_SIZE)
+                end_of_stream = not data
+                pending += data
+            chunk = pending[:CHUNK_SIZE]
+            total = str(offset + len(pending)) if end_of_stream else "*"
+            content_range = f"bytes {offset}-{offset + len(chunk) - 1}/{total}" if chunk else f"bytes */{total}"
+            try:
+                # Not retried by send: Drive may have stored part of a failed chunk, so the upload resumes from what it has
+                status, headers, response = await client.send("PUT", session_url, data=chunk, headers={"Content-Range": content_range}, max_retries=0)
+                failures = 0
+            except (GoogleApiError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if isinstance(e, GoogleApiError) and not e.is_retryable or failures == 5:
+                    raise
+                if isinstance(e, GoogleApiError) and e.is_rate_limit:
+                    get_rate_limiter(get_api_name(session_url)).on_rate_limited(e.retry_after)
+                wait_time = (2 ** failures) * 0.5 + random.random()
+                failures += 1
+                print(f"{e}. Resuming the upload in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
+                # An empty call with the total size, if known, asks Drive how much of the upload it stored
+                status, headers, response = await client.send("PUT", session_url, headers={"Content-Range": f"bytes */{total}"})
+            if status != 308:
+                return json.loads(response)
+
+            # The Range header holds the bytes Drive stored, e.g. "bytes=0-524287", and is missing when it stored none
+            stored_range = headers.get("Range")
+            stored = int(stored_range.rsplit("-", 1)[1]) + 1 if stored_range else 0
+            pending = pending[stored - offset:]
+            offset = stored
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+async def get_permissions(client: AsyncGoogleClient, folder_id: str, fields: str | list[str] = PERMISSION_FIELDS) -> list[dict]:
+    """
+    Gets the permissions from a drive.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        folder_id (str): The id of the drive to return its permissions
+        fields (str | list[str]): The fields to return per permission, e.g. "id,role" or "*" for all of them
+
+    Returns:
+        list[dict]: The list with all the permissions
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        permissions = []
+        page_token = None
+        while True:
+            params = {"supportsAllDrives": "true", "pageSize": 100, "fields": get_fields_mask(fields, "permissions")}
+            if page_token:
+                params["pageToken"] = page_token
+            response = await client.request("GET", f"{DRIVE_URL}/files/{folder_id}/permissions", params=params)
+            permissions.extend(response.get("permissions", []))
+
+            page_token = response.get("nextPageToken", None)
+            if not page_token:
+                return permissions
+    except Exception as e:
+        print(f"Error getting permissions: {e}")
+        return None
+
+async def create_permission(client: AsyncGoogleClient, file_id: str, permission: dict, send_notification_email: bool = False) -> dict:
+    """
+    Adds a permission to a drive, file or folder.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        file_id (str): The id of the drive, file or folder
+        permission (dict): The permission, e.g. {'type': 'user', 'role': 'reader', 'emailAddress': '...'}
+        send_notification_email (bool): Email the user or group about it, ignored for domain and anyone permissions
+
+    Returns:
+        dict: The new permission
+
+    Raises:
+        Exception: If an error occured.
+    """
+    params = {"supportsAllDrives": "true"}
+    # Notification emails can only be turned off (or on) for users and groups
+    if permission.get("type") in ("user", "group"):
+        params["sendNotificationEmail"] = "true" if send_notification_email else "false"
+    try:
+        return await client.request("POST", f"{DRIVE_URL}/files/{file_id}/permissions", params=params, json_body=permission)
+    except Exception as e:
+        print(f"Error creating permission: {e}")
+        return None
+
+async def update_parent_folder(client: AsyncGoogleClient, id: str, new_parent: str) -> dict:
+    """
+    Update parents for a Google file/folder.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        id (str): The id of the file/folder to update
+        new_parent (str): The id of the new parent folder
+
+    Returns:
+        dict: The File Resource of the Google file/folder
+
+    Raises:
+        Exception: If an error occured.
+    """
+    print(f"Updating the parent of: {id}")
+    try:
+        # Get the current parent IDs
+        file_metadata = await client.request("GET", f"{DRIVE_URL}/files/{id}", params={"supportsAllDrives": "true", "fields": "parents"})
+        old_parents = ",".join(file_metadata.get('parents', []))
+
+        # Update the parent
+        item = await client.request("PATCH", f"{DRIVE_URL}/files/{id}", json_body={}, params={
+            "supportsAllDrives": "true",
+            "addParents": new_parent,
+            "removeParents": old_parents,
+            "fields": "id,parents"
+        })
+        print(f"Updated file ID {id} to new parent ID {new_parent}")
+
+        return item
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+async def batch_update_parent(client: AsyncGoogleClient, batch_updates: list[dict]) -> dict:
+    """
+    Updates the parents of multiple files at the same time, see google_services.batch_update_parent.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        batch_updates (list[dict]): The updates, each with the 'fileId', 'addParents' and 'removeParents' of a file
+
+    Returns:
+        dict: The result of every update, by file ID
+            'status': "success" or "error"
+            'parents': The new parent IDs of the file if it was updated
+            'error': The error message if the update failed
+    """
+    async def update(file_update):
+        try:
+            response = await client.request("PATCH", f"{DRIVE_URL}/files/{file_update['fileId']}", json_body={}, params={
+                "supportsAllDrives": "true",
+                "addParents": file_update['addParents'],
+                "removeParents": file_update['removeParents'],
+                "fields": "id,parents"
+            })
+            return {'status': "success", 'parents': response.get('parents', [])}
+        except Exception as e:
+            print(f"Request ID: {file_update['fileId']} - Error: {e}")
+            return {'status': "error", 'error': str(e)}
+
+    updates = await asyncio.gather(*(update(file_update) for file_update in batch_updates))
+    results = {file_update['fileId']: result for file_update, result in zip(batch_updates, updates)}
+
+    print(f"{sum(result['status'] == 'success' for result in results.values())} of {len(results)} files updated")
+    return results
+
+async def get_values(client: AsyncGoogleClient, ss_id: str, range_name: str) -> list[list]:
+    """
+    Returns the values of a range of a Google Sheet.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        ss_id (str): The ID of the spreadsheet
+        range_name (str): The tab or range to read, e.g. 'Access' or 'Access!A:F'
+
+    Returns:
+        list[list]: The rows of the range
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        result = await client.request("GET", f"{SHEETS_URL}/spreadsheets/{ss_id}/values/{quote(range_name, safe='!:')}")
+        return result.get('values', [])
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+async def batch_get_values(client: AsyncGoogleClient, ss_id: str, range_names: list[str]) -> list[dict]:
+    """
+    Returns the data for the specified ranges of the Google Sheet.
+
+    Args:
+        client (AsyncGoogleClient): The client to send the calls with
+        ss_id (str): The ID of the spreadsheet
+        range_names (list[str]): A list containing all the ranges to retrieve
+
+    Returns:
+        list[dict]: The value range of every range, in the same order
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        result = await client.request("GET", f"{SHEETS_URL}/spreadsheets/{ss_id}/values:batchGet", params=[("ranges", range_name) for range_name in range_names])
+        ranges = result.get("valueRanges", [])
+        print(f"{len(ranges)} ranges retrieved")
+        return ranges
+    except Exception as error:
+        print(f"An error occurred: {error}")
+        return None
@@ -1,19 +1,102 @@
+from __future__ import annotations
+
 import functions_framework
+import flask
+import os
 import re
 import io
+import json
+import hashlib
+import hmac
+import secrets
+import time
+import queue
+import resource
+import tempfile
+import threading
+import multiprocessing
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from typing import BinaryIO, TYPE_CHECKING
+
+import httplib2
 
-from google.oauth2 import service_account
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.discovery import Resource
-from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
-from pypdf import PdfReader, PdfWriter
+from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload, MediaUpload
+
+# pypdf, the auth libraries and discovery are imported by the functions that use them, so a cold start doesn't wait
+# for them. pypdf is only loaded once a PDF is actually encrypted
+if TYPE_CHECKING:
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import Resource
+    from pypdf import PdfWriter
 
 # Define the scope
 SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly'] # 'https://www.googleapis.com/auth/spreadsheets',
 
 SERVICE_ACCOUNT_FILE = "path/to/file.json"
 
+# Number of PDFs processed at the same time, can be overridden per request with "workers"
+MAX_WORKERS = int(os.environ.get("PDF_MAX_WORKERS", "1"))
+# Upper bound for "workers", every worker builds its own drive service
+MAX_WORKERS_LIMIT = int(os.environ.get("PDF_MAX_WORKERS_LIMIT", "16"))
+
+# Where psw_protect_pdf runs: "thread" (in the calling thread) or "process" (in the warm process pool),
+# can be overridden per request with "encryption_mode"
+ENCRYPTION_MODE = os.environ.get("PDF_ENCRYPTION_MODE", "thread")
+PROCESS_WORKERS = int(os.environ.get("PDF_PROCESS_WORKERS", "0")) or os.cpu_count()
+
+# Kept at module level so the pool stays warm between invocations of the function
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+# PDF streams are kept in memory up to this size (in bytes), bigger ones are spilled to a temp file
+SPOOL_MAX_MEMORY = int(os.environ.get("PDF_SPOOL_MAX_MEMORY", str(32 * 1024 * 1024)))
+# Size of the download and upload chunks, the upload chunk size must be a multiple of 256 KB
+CHUNK_SIZE = int(os.environ.get("PDF_CHUNK_SIZE", str(8 * 1024 * 1024)))
+
+# How the PDFs are encrypted, each can be overridden per request with the option of the same name in lowercase.
+# PDF_ENCRYPTION_ALGORITHM is one of pypdf's algorithms ("RC4-40", "RC4-128", "AES-128", "AES-256-R5", "AES-256"),
+# left empty pypdf's default is used. PDF_CLONE_DOCUMENT copies the whole document (outlines, metadata, forms...)
+# instead of only the pages, PDF_COMPRESS compresses the page contents and removes duplicate objects.
+ENCRYPTION_ALGORITHM = os.environ.get("PDF_ENCRYPTION_ALGORITHM", "")
+CLONE_DOCUMENT = os.environ.get("PDF_CLONE_DOCUMENT", "false")
+COMPRESS = os.environ.get("PDF_COMPRESS", "false")
+
+# Upload the encrypted PDF while it is being written instead of after, can be overridden per request with "streaming_upload"
+STREAMING_UPLOAD = os.environ.get("PDF_STREAMING_UPLOAD", "false")
+
+# Return the existing protected copy when the same PDF, password and naming were protected before,
+# can be overridden per request with "cache"
+RESULT_CACHE = os.environ.get("PDF_RESULT_CACHE", "true")
+# Secret the cache keys are signed with, without it nothing is cached. Anyone who can read the appProperties of a
+# protected copy could otherwise brute force its password from the key
+RESULT_CACHE_SECRET = os.environ.get("PDF_RESULT_CACHE_SECRET", "")
+
+# The fields read for every source PDF
+FILE_FIELDS = "kind,id,name,mimeType,parents,webViewLink,md5Checksum,headRevisionId,shortcutDetails"
+# Drive accepts at most 100 calls in a batch request
+BATCH_SIZE = 100
+
+# Add the per-stage timings to the response and not only to the logs, can be overridden per request with "timings"
+RESPONSE_TIMINGS = os.environ.get("PDF_RESPONSE_TIMINGS", "false")
+
+# Parsed discovery documents, kept at module level so warm invocations don't load and parse them again
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+
+# Jobs started with "async": true. They only exist in the memory of the instance that runs them,
+# finished jobs are removed after JOB_TTL seconds
+_jobs = {}
+# The hash of the access token that started each job, see get_token_hash
+_job_owners = {}
+_jobs_lock = threading.Lock()
+JOB_TTL = int(os.environ.get("PDF_JOB_TTL", "3600"))
+
+# Settings that can be given in the request and are passed on to encrypt_pdfs as options
+REQUEST_OPTIONS = ["encryption_mode", "streaming_upload", "cache", "encryption_algorithm", "clone_document", "compress", "timings"]
+
 @functions_framework.http
 def http_request_handler(request):
     """HTTP Cloud Function.
@@ -25,6 +108,13 @@ def http_request_handler(request):
         Response object using `make_response`
         <https://flask.palletsprojects.com/en/1.1.x/api/#flask.make_response>.
 
+    With "async": true the PDFs are processed in the background and the response is the job, e.g. {"job_id": "..."}.
+    Its progress and results can then be requested with ?job_id=[job id here] (GET or POST), with the same access token.
+    Jobs are kept in the instance's memory, so the function needs a single instance with CPU always allocated.
+
+    With "stream": true the response is NDJSON with a line per PDF as soon as it is done, see encrypt_pdfs for the
+    fields of each line plus 'index', the position of the PDF in the request.
+
     {
         "pdfs": [
             {
@@ -33,7 +123,17 @@ def http_request_handler(request):
             "protect": true
             }
         ],
-        "naming": "Protected_"
+        "naming": "Protected_",
+        "workers": 4,
+        "encryption_mode": "process",
+        "streaming_upload": true,
+        "cache": true,
+        "encryption_algorithm": "AES-256",
+        "clone_document": true,
+        "compress": true,
+        "timings": true,
+        "async": false,
+        "stream": false
     }
     """
     request_json = request.get_json(silent=True)
@@ -54,6 +154,44 @@ def http_request_handler(request):
     elif request_args and 'naming' in request_args:
         naming_prefix = request_args['naming']
 
+    max_workers = None
+    if request_json and 'workers' in request_json:
+        max_workers = request_json['workers']
+    elif request_args and 'workers' in request_args:
+        max_workers = request_args['workers']
+
+    options = {}
+    for option in REQUEST_OPTIONS:
+        if request_json and option in request_json:
+            options[option] = request_json[option]
+        elif request_args and option in request_args:
+            options[option] = request_args[option]
+
+    job_id = None
+    if request_json and 'job_id' in request_json:
+        job_id = request_json['job_id']
+    elif request_args and 'job_id' in request_args:
+        job_id = request_args['job_id']
+
+    run_async = False
+    if request_json and 'async' in request_json:
+        run_async = is_enabled(request_json['async'])
+    elif request_args and 'async' in request_args:
+        run_async = is_enabled(request_args['async'])
+
+    stream = False
+    if request_json and 'stream' in request_json:
+        stream = is_enabled(request_json['stream'])
+    elif request_args and 'stream' in request_args:
+        stream = is_enabled(request_args['stream'])
+
+    # Status of a job started earlier
+    if job_id:
+        job = get_job(job_id, access_token)
+        if job is None:
+            return "Unknown job", 404
+        return job, 200
+
     # Check if the request was a POST request
     if request.method != "POST":
         # not adding "Aborting" to the log because that triggers a different alert
@@ -66,13 +204,30 @@ def http_request_handler(request):
         # print("Missing required parameters")
         return "Missing required parameters", 400
 
-    encrypted_pdfs = encrypt_pdfs(access_token, pdfs_to_encrypt, naming_prefix)
+    if max_workers is not None:
+        try:
+            max_workers = int(max_workers)
+        except (TypeError, ValueError):
+            return "Invalid workers", 400
+
+    if run_async:
+        job = start_job(access_token, pdfs_to_encrypt, naming_prefix, max_workers, options)
+        return job, 202
+
+    if stream:
+        def generate():
+            for index, result in iter_encrypt_pdfs(access_token, pdfs_to_encrypt, naming_prefix, max_workers, options):
+                yield json.dumps({"index": index, **result}) + "\n"
+
+        return flask.Response(generate(), mimetype="application/x-ndjson"), 200
+
+    encrypted_pdfs = encrypt_pdfs(access_token, pdfs_to_encrypt, naming_prefix, max_workers, options)
 
     return encrypted_pdfs, 200
 
-def encrypt_pdfs(access_token, pdfs: list[dict], naming_prefix: str) -> list[str]:
+def encrypt_pdfs(access_token, pdfs: list[dict], naming_prefix: str, max_workers: int = None, options: dict = None) -> list[dict]:
     """
-    Returns the list of encrypted pdf URLs
+    Returns the result of encrypting each of the given PDFs, in the same order as the input
 
     Args:
         pdfs (list[dict]): The list of PDF dict to be encrypted.
@@ -80,66 +235,325 @@ def encrypt_pdfs(access_token, pdfs: list[dict], naming_prefix: str) -> list[str
             'password': The password of the encrypted PDF
             'protect': Bool to indicate if file needs to be protected or not
         naming_prefix (str): String that needs to be added to beginning of each PDF name
+        max_workers (int): The number of PDFs to process at the same time, defaults to PDF_MAX_WORKERS, at most PDF_MAX_WORKERS_LIMIT
+        options (dict): Optional settings for how the PDFs are processed.
+            'encryption_mode': "thread" or "process", defaults to PDF_ENCRYPTION_MODE
+            'streaming_upload': Upload the PDF while it is being encrypted, defaults to PDF_STREAMING_UPLOAD.
+                The encryption then always runs in a thread, so 'encryption_mode' is ignored.
+            'cache': Return the protected copy made by an earlier request for the same file version, password
+                and naming instead of protecting it again, defaults to PDF_RESULT_CACHE, only works when PDF_RESULT_CACHE_SECRET is set
+            'encryption_algorithm': The pypdf encryption algorithm, e.g. "AES-256", defaults to PDF_ENCRYPTION_ALGORITHM
+            'clone_document': Copy the whole document instead of only its pages, defaults to PDF_CLONE_DOCUMENT
+            'compress': Compress the page contents and remove duplicate objects, defaults to PDF_COMPRESS
+            'timings': Include the per-stage timings in the stats, defaults to PDF_RESPONSE_TIMINGS.
+                They are always written to the logs.
 
     Returns:
-        dict: The File Resource of the found or created folder
+        list[dict]: One entry per PDF
+            'url': The URL of the PDF
+            'status': "success" or "error"
+            'file': The File Resource of the encrypted PDF, or the original URL if it didn't need protection
+            'error': The error message if the PDF couldn't be encrypted
+            'stats': Measurements for the PDF, 'peak_rss_kb' is the peak resident memory of the function
+                and 'cache_hit' is True when an earlier protected copy was returned.
+                'input_bytes', 'output_bytes' and 'encrypt_seconds' are the size of the PDF before and after
+                encryption and how long the encryption took, 'pages' is its number of pages.
+                'timings' has the seconds spent in each stage: 'get_file', 'cache_lookup', 'download',
+                'encrypt' and 'upload' (or 'encrypt_and_upload' when streaming the upload) and 'total'.
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        encrypted_pdfs = [None] * len(pdfs)
+        for index, result in iter_encrypt_pdfs(access_token, pdfs, naming_prefix, max_workers, options):
+            encrypted_pdfs[index] = result
+        return encrypted_pdfs
+
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+def iter_encrypt_pdfs(access_token, pdfs: list[dict], naming_prefix: str, max_workers: int = None, options: dict = None):
+    """
+    Encrypts the given PDFs and yields the result of each one as soon as it is done, see encrypt_pdfs.
+
+    Args:
+        pdfs (list[dict]): The list of PDF dict to be encrypted, see encrypt_pdfs
+        naming_prefix (str): String that needs to be added to beginning of each PDF name
+        max_workers (int): The number of PDFs to process at the same time, defaults to PDF_MAX_WORKERS, at most PDF_MAX_WORKERS_LIMIT
+        options (dict): Optional settings for how the PDFs are processed, see encrypt_pdfs
+
+    Yields:
+        tuple[int, dict]: The position of the PDF in pdfs and its result entry
 
     Raises:
         Exception: If an error occured.
     """
+    from google.oauth2.credentials import Credentials
+
+    # creds = get_credentials(SERVICE_ACCOUNT_FILE, SCOPES)
+    creds = Credentials(token=access_token)
+
+    workers = int(max_workers or MAX_WORKERS)
+    workers = max(1, min(workers, MAX_WORKERS_LIMIT, len(pdfs)))
+
+    drive_service = create_service('drive', "v3", credentials=creds)
+
+    # Get the metadata of every PDF in one go, encrypt_pdf falls back to get_file for any that are missing
+    timings = {}
+    with timed(timings, "get_files"):
+        file_ids = [get_id_from_url(file["url"]) for file in pdfs if file.get("protect") and file.get("url")]
+        drive_files = get_files(drive_service, [file_id for file_id in file_ids if file_id]) or {}
+    log_json("PDF metadata", files=len(file_ids), found=len(drive_files), timings=timings)
+
+    def get_drive_file(file):
+        if not file.get("protect") or not file.get("url"):
+            return None
+        return drive_files.get(get_id_from_url(file["url"]))
+
+    if workers == 1:
+        for index, file in enumerate(pdfs):
+            # Only one file is in flight, so the peak memory can be measured per file
+            reset_peak_rss()
+            yield index, encrypt_pdf(drive_service, file, naming_prefix, options, get_drive_file(file))
+        return
+
+    # The service's http connection isn't thread safe, so every worker builds its own
+    local = threading.local()
+
+    def worker(file):
+        if not hasattr(local, "drive_service"):
+            local.drive_service = create_service('drive', "v3", credentials=creds)
+        return encrypt_pdf(local.drive_service, file, naming_prefix, options, get_drive_file(file))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(worker, file): index for index, file in enumerate(pdfs)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def start_job(access_token, pdfs: list[dict], naming_prefix: str, max_workers: int = None, options: dict = None) -> dict:
+    """
+    Starts encrypting the given PDFs in a background thread, see encrypt_pdfs.
+    The job can only be read with the access token that started it.
+
+    Args:
+        access_token (str): The access token of the caller
+        pdfs (list[dict]): The list of PDF dict to be encrypted, see encrypt_pdfs
+        naming_prefix (str): String that needs to be added to beginning of each PDF name
+        max_workers (int): The number of PDFs to process at the same time, defaults to PDF_MAX_WORKERS, at most PDF_MAX_WORKERS_LIMIT
+        options (dict): Optional settings for how the PDFs are processed, see encrypt_pdfs
+
+    Returns:
+        dict: The job, see get_job
+    """
+    job = {
+        "job_id": secrets.token_urlsafe(32),
+        "status": "running",
+        "total": len(pdfs),
+        "completed": 0,
+        "results": [None] * len(pdfs),
+        "started": time.time(),
+        "finished": None
+    }
+
+    with _jobs_lock:
+        # Forget about jobs that finished a while ago
+        for old_job_id, old_job in list(_jobs.items()):
+            if old_job["finished"] and old_job["finished"] < time.time() - JOB_TTL:
+                del _jobs[old_job_id]
+                del _job_owners[old_job_id]
+        _jobs[job["job_id"]] = job
+        # Only a hash of the token is kept, the token itself is only needed while the job runs
+        _job_owners[job["job_id"]] = get_token_hash(access_token)
+
+    def run_job():
+        try:
+            for index, result in iter_encrypt_pdfs(access_token, pdfs, naming_prefix, max_workers, options):
+                with _jobs_lock:
+                    job["results"][index] = result
+                    job["completed"] += 1
+            status = "done"
+        except Exception as e:
+            print(f'An error occurred: {e}')
+            status = "error"
+            job["error"] = str(e)
+        with _jobs_lock:
+            job["status"] = status
+            job["finished"] = time.time()
+
+    threading.Thread(target=run_job, daemon=True).start()
+    return get_job(job["job_id"], access_token)
+
+def get_job(job_id: str, access_token: str) -> dict:
+    """
+    Returns the progress and results of a job started with start_job.
+
+    Args:
+        job_id (str): The id of the job
+        access_token (str): The access token of the caller, it must be the one the job was started with
+
+    Returns:
+        dict: A copy of the job, or None if it doesn't exist on this instance or belongs to another caller
+            'job_id': The id of the job
+            'status': "running", "done" or "error"
+            'total': The number of PDFs in the job
+            'completed': The number of PDFs that are done
+            'results': The result entry of each PDF, see encrypt_pdfs, None for PDFs that aren't done yet
+            'started': When the job started, as a Unix timestamp
+            'finished': When the job finished, as a Unix timestamp
+    """
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or not hmac.compare_digest(_job_owners[job_id], get_token_hash(access_token)):
+            return None
+        return {**job, "results": list(job["results"])}
+
+def get_token_hash(access_token: str) -> str:
+    """
+    Returns the hash that identifies the caller of a job without keeping their access token.
+
+    Args:
+        access_token (str): The access token of the caller
+
+    Returns:
+        str: The SHA-256 of the token
+    """
+    return hashlib.sha256(str(access_token).encode("utf-8")).hexdigest()
+
+def encrypt_pdf(drive_service: Resource, file: dict, naming_prefix: str, options: dict = None, drive_file: dict = None) -> dict:
+    """
+    Downloads, password protects and uploads a single PDF.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        file (dict): The PDF dict to be encrypted, see encrypt_pdfs
+        naming_prefix (str): String that needs to be added to beginning of the PDF name
+        options (dict): Optional settings for how the PDF is processed, see encrypt_pdfs
+        drive_file (dict): The File Resource of the PDF if it was already fetched, see get_files
+
+    Returns:
+        dict: The result entry for the PDF, see encrypt_pdfs
+    """
+    options = options or {}
+    timings = {}
+    result = {"url": file.get("url"), "status": "success", "file": None, "stats": {"timings": timings}}
+    pdf_stream = None
+    encrypted_pdf_stream = None
+    start = time.perf_counter()
     try:
-        # creds = get_credentials(SERVICE_ACCOUNT_FILE, SCOPES)
-        creds = Credentials(token=access_token)
-        drive_service = create_service('drive', "v3", credentials=creds)
+        print(file)
+        if not file.get("protect"):
+            result["file"] = file.get("url")
+            return result
+
+        if drive_service is None:
+            raise Exception("Could not create the drive service")
 
-        encrypted_pdfs = []
-        for file in pdfs:
-            print(file)
-            if file["protect"]:
-                file_id = get_id_from_url(file["url"])
-                password = file["password"]
+        file_id = get_id_from_url(file["url"])
+        if not file_id:
+            raise Exception("Could not find a file id in the url")
+        password = file["password"]
 
+        if drive_file is None:
+            with timed(timings, "get_file"):
                 drive_file = get_file(drive_service, file_id)
-                if drive_file:
-                    pdf_stream = stream_pdf_from_drive(drive_service, file_id)
-                    encrypted_pdf_stream = psw_protect_pdf(pdf_stream, password)
-
-                    print("Current File:")
-                    print(drive_file)
-                    file_name = drive_file.get("name", "")
-                    parents = drive_file.get("parents", None)
-
-                    new_file_name = f"{naming_prefix}{file_name}"
-                    new_file = upload_pdf_to_drive(drive_service, encrypted_pdf_stream, new_file_name, parents)
-                    encrypted_pdfs.append(new_file)
-                    print(f"Encrypted PDF uploaded successfully with ID: {new_file}")
-            else:
-                encrypted_pdfs.append(file["url"])
-        return encrypted_pdfs
+        if not drive_file:
+            raise Exception(f"Could not get the file {file_id}")
+        # Differs from the id in the url when the url is a shortcut
+        file_id = drive_file["id"]
+
+        print("Current File:")
+        print(drive_file)
+        file_name = drive_file.get("name", "")
+        parents = drive_file.get("parents", None)
+        new_file_name = f"{naming_prefix}{file_name}"
+
+        app_properties = None
+        protection_key = None
+        encryption_settings = {
+            "algorithm": options.get("encryption_algorithm", ENCRYPTION_ALGORITHM) or None,
+            "clone": is_enabled(options.get("clone_document", CLONE_DOCUMENT)),
+            "compress": is_enabled(options.get("compress", COMPRESS))
+        }
+
+        if is_enabled(options.get("cache", RESULT_CACHE)):
+            protection_key = get_protection_key(drive_file, password, naming_prefix, encryption_settings["algorithm"])
+        if protection_key:
+            with timed(timings, "cache_lookup"):
+                cached_file = find_protected_file(drive_service, protection_key, parents)
+            if cached_file:
+                result["file"] = cached_file
+                result["stats"]["cache_hit"] = True
+                print(f"Encrypted PDF already exists with ID: {cached_file}")
+                return result
+            app_properties = {"protectedFrom": file_id, "protectionKey": protection_key}
+
+        with timed(timings, "download"):
+            pdf_stream = stream_pdf_from_drive(drive_service, file_id)
+        if pdf_stream is None:
+            raise Exception(f"Could not download the file {file_id}")
+
+        if is_enabled(options.get("streaming_upload", STREAMING_UPLOAD)):
+            with timed(timings, "encrypt_and_upload"):
+                new_file = stream_protected_pdf_to_drive(
+                    drive_service, pdf_stream, password, new_file_name, parents, app_properties,
+                    encryption_settings, result["stats"]
+                )
+        else:
+            use_process_pool = options.get("encryption_mode", ENCRYPTION_MODE) == "process"
+            with timed(timings, "encrypt"):
+                encrypted_pdf_stream = psw_protect_pdf(pdf_stream, password, use_process_pool, encryption_settings, result["stats"])
+            if encrypted_pdf_stream is None:
+                raise Exception(f"Could not encrypt the file {file_id}")
+            pdf_stream.close()
+
+            with timed(timings, "upload"):
+                new_file = upload_pdf_to_drive(drive_service, encrypted_pdf_stream, new_file_name, parents, app_properties)
+
+        if not new_file:
+            raise Exception(f"Could not upload {new_file_name}")
+
+        result["file"] = new_file
+        print(f"Encrypted PDF uploaded successfully with ID: {new_file}")
+        return result
 
     except Exception as e:
         print(f'An error occurred: {e}')
-        return None
+        result["status"] = "error"
+        result["error"] = str(e)
+        return result
 
+    finally:
+        # Closing the spooled streams removes their temp files
+        for stream in (pdf_stream, encrypted_pdf_stream):
+            if stream is not None:
+                stream.close()
+        result["stats"]["peak_rss_kb"] = get_peak_rss()
+        timings["total"] = round(time.perf_counter() - start, 3)
+        log_json("PDF protection", url=result["url"], status=result["status"], **result["stats"])
+        if not is_enabled(options.get("timings", RESPONSE_TIMINGS)):
+            del result["stats"]["timings"]
 
-def stream_pdf_from_drive(drive_service: Resource, file_id: str) -> io.BytesIO:
+def stream_pdf_from_drive(drive_service: Resource, file_id: str) -> BinaryIO:
     """
     Download a file from Google Drive as a stream.
+    The stream is kept in memory up to SPOOL_MAX_MEMORY bytes and spilled to a temp file beyond that.
 
     Args:
         drive_service (Resource): The authenticated drive service instance
         file_id (str): The id of the Google Gile to stream
 
     Returns:
-        file_stream (BytesIO): The Google File's stream
+        file_stream (BinaryIO): The Google File's stream
 
     Raises:
         Exception: If an error occured.
     """
     try:
         request = drive_service.files().get_media(fileId=file_id)
-        file_stream = io.BytesIO()
-        downloader = MediaIoBaseDownload(file_stream, request)
+        file_stream = create_spooled_stream()
+        downloader = MediaIoBaseDownload(file_stream, request, chunksize=CHUNK_SIZE)
         done = False
         while not done:
             status, done = downloader.next_chunk()
@@ -149,31 +563,44 @@ def stream_pdf_from_drive(drive_service: Resource, file_id: str) -> io.BytesIO:
         print(f'An error occurred: {e}')
         return None
 
-def psw_protect_pdf(pdf_stream: io.BytesIO, password: str) -> io.BytesIO:
+def psw_protect_pdf(pdf_stream: BinaryIO, password: str, use_process_pool: bool = False, encryption_settings: dict = None, stats: dict = None) -> BinaryIO:
     """
-    Password Protect a PDF in memory.
+    Password Protect a PDF.
+    The encrypted stream is kept in memory up to SPOOL_MAX_MEMORY bytes and spilled to a temp file beyond that.
 
     Args:
-        pdf_stream (io.BytesIO): The pdf file stream
+        pdf_stream (BinaryIO): The pdf file stream
         password (str): The password to encrypt the PDF with
+        use_process_pool (bool): Encrypt the PDF in the warm process pool instead of the calling thread.
+            The PDF is passed to the pool as bytes, so it is held in memory while it is being encrypted.
+        encryption_settings (dict): The algorithm, clone and compress arguments of create_encrypted_writer
+        stats (dict): If given, 'input_bytes', 'output_bytes', 'encrypt_seconds' and 'pages' are added to it
 
     Returns:
-        encrypted_stream (io.BytesIO): The encrypted pdf file stream
+        encrypted_stream (BinaryIO): The encrypted pdf file stream
 
     Raises:
         Exception: If an error occured.
     """
     try:
-        reader = PdfReader(pdf_stream)
-        writer = PdfWriter()
-        
-        for page in reader.pages:
-            writer.add_page(page)
-        
-        writer.encrypt(password)
-        
-        encrypted_stream = io.BytesIO()
-        writer.write(encrypted_stream)
+        start = time.perf_counter()
+        input_bytes = get_stream_size(pdf_stream)
+        encrypted_stream = create_spooled_stream()
+
+        if use_process_pool:
+            encrypted_bytes, pages = run_in_process_pool(encrypt_pdf_bytes, pdf_stream.read(), password, encryption_settings)
+            encrypted_stream.write(encrypted_bytes)
+        else:
+            writer = create_encrypted_writer(pdf_stream, password, **(encryption_settings or {}))
+            writer.write(encrypted_stream)
+            pages = len(writer.pages)
+
+        if stats is not None:
+            stats["input_bytes"] = input_bytes
+            stats["output_bytes"] = encrypted_stream.tell()
+            stats["encrypt_seconds"] = round(time.perf_counter() - start, 3)
+            stats["pages"] = pages
+
         encrypted_stream.seek(0)
         return encrypted_stream
 
@@ -181,15 +608,352 @@ def psw_protect_pdf(pdf_stream: io.BytesIO, password: str) -> io.BytesIO:
         print(f'An error occurred: {e}')
         return None
 
-def upload_pdf_to_drive(drive_service: Resource, encrypted_stream: io.BytesIO, filename: str, parent_folder_id: str = None) -> dict:
+def create_encrypted_writer(pdf_stream: BinaryIO, password: str, algorithm: str = None, clone: bool = False, compress: bool = False) -> PdfWriter:
+    """
+    Returns a PdfWriter with the PDF, encrypted with the given password.
+
+    Args:
+        pdf_stream (BinaryIO): The pdf file stream
+        password (str): The password to encrypt the PDF with
+        algorithm (str): The pypdf encryption algorithm, e.g. "AES-256", None for pypdf's default
+        clone (bool): Copy the whole document (outlines, metadata, forms...) instead of only its pages
+        compress (bool): Compress the page contents and remove duplicate objects, smaller but slower to write
+
+    Returns:
+        PdfWriter: The encrypted PDF, ready to be written
+    """
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(pdf_stream)
+
+    if clone:
+        writer = PdfWriter(clone_from=reader)
+    else:
+        writer = PdfWriter()
+        
+        for page in reader.pages:
+            writer.add_page(page)
+
+    if compress:
+        for page in writer.pages:
+            page.compress_content_streams()
+        writer.compress_identical_objects()
+    
+    writer.encrypt(password, algorithm=algorithm)
+    return writer
+
+def stream_protected_pdf_to_drive(drive_service: Resource, pdf_stream: BinaryIO, password: str, filename: str, parent_folder_id: str = None, app_properties: dict = None, encryption_settings: dict = None, stats: dict = None) -> dict:
+    """
+    Password Protect a PDF and upload it to Google Drive at the same time.
+    The encrypted PDF is written into a PdfUploadPipe by a background thread while the resumable upload
+    sends it chunk by chunk, so the whole encrypted PDF is never held in memory.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        pdf_stream (BinaryIO): The pdf file stream
+        password (str): The password to encrypt the PDF with
+        filename (str): The name of the file to save the stream as
+        parent_folder_id (str): The id of the drive folder to save the file in
+        app_properties (dict): The appProperties to set on the new file
+        encryption_settings (dict): The algorithm, clone and compress arguments of create_encrypted_writer
+        stats (dict): If given, 'input_bytes', 'output_bytes', 'encrypt_seconds' and 'pages' are added to it.
+            The encryption time includes the time spent waiting for the upload.
+
+    Returns:
+        file (dict): The newly created file in Google Drive
+    """
+    pipe = PdfUploadPipe()
+    input_bytes = get_stream_size(pdf_stream)
+    encrypt_seconds = None
+    pages = None
+
+    def write_encrypted_pdf():
+        nonlocal encrypt_seconds, pages
+        try:
+            start = time.perf_counter()
+            writer = create_encrypted_writer(pdf_stream, password, **(encryption_settings or {}))
+            pages = len(writer.pages)
+            writer.write(pipe)
+            encrypt_seconds = round(time.perf_counter() - start, 3)
+            pipe.close()
+        except Exception as e:
+            pipe.close(e)
+
+    writer_thread = threading.Thread(target=write_encrypted_pdf, daemon=True)
+    writer_thread.start()
+
+    file = upload_pdf_to_drive(drive_service, pipe, filename, parent_folder_id, app_properties)
+
+    # Unblocks the writer if the upload stopped before reading everything
+    pipe.abort()
+    writer_thread.join()
+
+    if stats is not None:
+        stats["input_bytes"] = input_bytes
+        stats["output_bytes"] = pipe.tell()
+        stats["encrypt_seconds"] = encrypt_seconds
+        stats["pages"] = pages
+    return file
+
+class PdfUploadPipe(MediaUpload):
+    """
+    Resumable upload media that is filled while the upload is running.
+
+    The writer side (write, tell, close) is used by PdfWriter.write from another thread,
+    the upload side (getbytes, size) by the resumable upload. At most max_chunks chunks are
+    queued in between, so the writer waits when the upload falls behind.
+    """
+
+    def __init__(self, chunksize: int = CHUNK_SIZE, mimetype: str = "application/pdf", max_chunks: int = 2):
+        self._chunksize = chunksize
+        self._mimetype = mimetype
+        self._queue = queue.Queue(maxsize=max_chunks)
+        self._aborted = False
+
+        # Writer side
+        self._pending = bytearray()
+        self._written = 0
+
+        # Upload side, the buffer holds the bytes from _buffer_start onwards that might still be (re)sent
+        self._buffer = bytearray()
+        self._buffer_start = 0
+        self._next_begin = 0
+        self._eof = False
+        self._error = None
+
+    def write(self, data: bytes) -> int:
+        self._pending += data
+        self._written += len(data)
+        while len(self._pending) >= self._chunksize:
+            self._put(bytes(self._pending[:self._chunksize]))
+            del self._pending[:self._chunksize]
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+    def flush(self):
+        pass
+
+    def close(self, error: Exception = None):
+        """Marks the end of the PDF, or passes the error that stopped the writer on to the upload."""
+        if self._aborted:
+            return
+        if error is None and self._pending:
+            self._put(bytes(self._pending))
+            self._pending.clear()
+        self._put(error)
+
+    def abort(self):
+        """Stops the writer, used when the upload ended early."""
+        self._aborted = True
+
+    def _put(self, item):
+        while True:
+            if self._aborted:
+                raise Exception("The upload was aborted")
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _fill(self, end: int):
+        """Reads from the writer until the buffer reaches the given offset or the end of the PDF."""
+        while not self._eof and self._buffer_start + len(self._buffer) < end:
+            if self._error is not None:
+                raise self._error
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, Exception):
+                self._error = item
+            else:
+                self._buffer += item
+
+    def chunksize(self) -> int:
+        return self._chunksize
+
+    def mimetype(self) -> str:
+        return self._mimetype
+
+    def size(self) -> int:
+        # The size is only known once the writer is done. Reading one byte past the next chunk makes sure the last
+        # chunk is sent with the total size, even when the PDF is an exact multiple of the chunk size
+        self._fill(self._next_begin + self._chunksize + 1)
+        if self._eof:
+            return self._buffer_start + len(self._buffer)
+        return None
+
+    def resumable(self) -> bool:
+        return True
+
+    def has_stream(self) -> bool:
+        return False
+
+    def getbytes(self, begin: int, length: int) -> bytes:
+        if begin < self._buffer_start:
+            raise Exception(f"Can't resend bytes from {begin}, they were already dropped")
+        del self._buffer[:begin - self._buffer_start]
+        self._buffer_start = begin
+        self._fill(begin + length)
+        data = bytes(self._buffer[:length])
+        self._next_begin = begin + len(data)
+        return data
+
+def encrypt_pdf_bytes(pdf_bytes: bytes, password: str, encryption_settings: dict = None) -> tuple[bytes, int]:
+    """
+    Password Protect a PDF given as bytes. Used as the process pool task, so it only takes and returns bytes.
+
+    Args:
+        pdf_bytes (bytes): The pdf file contents
+        password (str): The password to encrypt the PDF with
+        encryption_settings (dict): The algorithm, clone and compress arguments of create_encrypted_writer
+
+    Returns:
+        tuple[bytes, int]: The encrypted pdf file contents and its number of pages
+
+    Raises:
+        Exception: If an error occured.
+    """
+    stats = {}
+    encrypted_stream = psw_protect_pdf(io.BytesIO(pdf_bytes), password, encryption_settings=encryption_settings, stats=stats)
+    if encrypted_stream is None:
+        raise Exception("Could not encrypt the PDF")
+    with encrypted_stream:
+        return encrypted_stream.read(), stats["pages"]
+
+def get_stream_size(stream: BinaryIO) -> int:
+    """
+    Returns the size of a stream in bytes and moves it back to its start.
+
+    Args:
+        stream (BinaryIO): A seekable stream
+
+    Returns:
+        int: The size of the stream in bytes
+    """
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+def create_spooled_stream() -> BinaryIO:
+    """
+    Returns an empty stream that stays in memory until it grows past SPOOL_MAX_MEMORY bytes,
+    after which it is moved to a temp file that is removed when the stream is closed.
+
+    Returns:
+        BinaryIO: The spooled stream
+    """
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY, mode="w+b")
+
+@contextmanager
+def timed(timings: dict, stage: str):
+    """
+    Adds the seconds spent in the with block to timings under the name of the stage.
+
+    Args:
+        timings (dict): The timings to add to
+        stage (str): The name of the stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+
+def log_json(message: str, **fields):
+    """
+    Prints a structured log line, Cloud Logging turns the JSON fields into the jsonPayload of the entry.
+
+    Args:
+        message (str): The message of the log entry
+        **fields: The fields to add to the log entry
+    """
+    print(json.dumps({"severity": "INFO", "message": message, **fields}, default=str))
+
+def reset_peak_rss():
+    """
+    Resets the peak resident memory of the process, so the next get_peak_rss only covers what ran after it.
+    Only supported on Linux, elsewhere the peak keeps covering the whole life of the process.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+def get_peak_rss() -> int:
+    """
+    Returns the peak resident memory of the process in KB.
+    Memory used by the encryption process pool is not included.
+
+    Returns:
+        int: The peak resident memory in KB
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Returns the process pool used for encryption, creating it on first use.
+
+    Returns:
+        ProcessPoolExecutor: The warm process pool
+    """
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn instead of fork, the parent has worker threads running while the pool starts
+            _process_pool = ProcessPoolExecutor(
+                max_workers=PROCESS_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _process_pool
+
+def run_in_process_pool(fn, *args):
+    """
+    Runs the function in the process pool and waits for its result.
+    If the pool broke (e.g. a worker got killed) it is replaced and the call is tried once more.
+
+    Args:
+        fn (callable): A module level function to run
+        *args: The arguments to call it with
+
+    Returns:
+        The result of the function
+
+    Raises:
+        Exception: If an error occured.
+    """
+    global _process_pool
+    pool = get_process_pool()
+    try:
+        return pool.submit(fn, *args).result()
+    except BrokenProcessPool:
+        with _process_pool_lock:
+            if _process_pool is pool:
+                _process_pool = None
+        pool.shutdown(wait=False)
+        return get_process_pool().submit(fn, *args).result()
+
+def upload_pdf_to_drive(drive_service: Resource, encrypted_stream: BinaryIO | MediaUpload, filename: str, parent_folder_id: str = None, app_properties: dict = None) -> dict:
     """
     Upload an encrypted PDF to Google Drive.
 
     Args:
         drive_service (Resource): The authenticated drive service instance
-        encrypted_stream (io.BytesIO): The encrypted pdf file stream
+        encrypted_stream (BinaryIO | MediaUpload): The encrypted pdf file stream, or the media to upload it from
         filename (str): The name of the file to save the stream as
         parent_folder_id (str): The id of the drive folder to save the file in
+        app_properties (dict): The appProperties to set on the new file
 
     Returns:
         file (dict): The newly created file in Google Drive
@@ -204,8 +968,14 @@ def upload_pdf_to_drive(drive_service: Resource, encrypted_stream: io.BytesIO, f
 
         if parent_folder_id:
             file_metadata["parents"] = parent_folder_id
+
+        if app_properties:
+            file_metadata["appProperties"] = app_properties
         
-        media = MediaIoBaseUpload(encrypted_stream, mimetype="application/pdf", resumable=True)
+        if isinstance(encrypted_stream, MediaUpload):
+            media = encrypted_stream
+        else:
+            media = MediaIoBaseUpload(encrypted_stream, mimetype="application/pdf", chunksize=CHUNK_SIZE, resumable=True)
         file = drive_service.files().create(
             supportsAllDrives=True,
             body=file_metadata, 
@@ -218,6 +988,67 @@ def upload_pdf_to_drive(drive_service: Resource, encrypted_stream: io.BytesIO, f
         print(f'An error occurred: {e}')
         return None
 
+def get_protection_key(drive_file: dict, password: str, naming_prefix: str, algorithm: str = None) -> str:
+    """
+    Returns the key that identifies a protected copy of a specific version of a file.
+    The key is stored in the appProperties of the protected copy so later requests can find it.
+    It is an HMAC signed with PDF_RESULT_CACHE_SECRET, so it can't be used to guess the password.
+
+    Args:
+        drive_file (dict): The File Resource of the original PDF, with its md5Checksum or headRevisionId
+        password (str): The password of the encrypted PDF
+        naming_prefix (str): String that is added to beginning of the PDF name
+        algorithm (str): The encryption algorithm, if it isn't pypdf's default
+
+    Returns:
+        str: The protection key, or None if the version of the file is unknown or no secret is set
+    """
+    if not RESULT_CACHE_SECRET:
+        return None
+
+    version = drive_file.get("md5Checksum") or drive_file.get("headRevisionId")
+    if not version:
+        return None
+
+    # The password is only ever stored as part of this HMAC
+    parts = [drive_file["id"], version, str(password), naming_prefix]
+    if algorithm:
+        parts.append(algorithm)
+    key = "\n".join(parts)
+    return hmac.new(RESULT_CACHE_SECRET.encode("utf-8"), key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def find_protected_file(drive_service: Resource, protection_key: str, parent_folder_id: list[str] = None) -> dict:
+    """
+    Returns the protected copy with the given protection key, see get_protection_key.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        protection_key (str): The protection key of the copy
+        parent_folder_id (list[str]): The ids of the folders the copy was saved in
+
+    Returns:
+        dict: The File Resource of the protected copy, or None if there isn't one
+    """
+    try:
+        query = f"appProperties has {{ key='protectionKey' and value='{protection_key}' }} and trashed=false"
+        if parent_folder_id:
+            query = f"'{parent_folder_id[0]}' in parents and {query}"
+
+        response = drive_service.files().list(
+            q=query,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+            pageSize=1,
+            fields="files(kind,id,name,mimeType,parents,webViewLink)"
+        ).execute()
+        files = response.get('files', [])
+        if files:
+            return files[0]
+        return None
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
 def get_folder(drive_service: Resource, parent_folder_id: str, folder_name: str) -> dict:
     """
     Returns the folder with the specified name in the specified parent folder. 
@@ -270,7 +1101,7 @@ def get_file(drive_service: Resource, file_id: str) -> dict:
         response = drive_service.files().get(
             fileId=file_id, 
             supportsAllDrives=True,
-            fields="kind,id,name,mimeType,parents,webViewLink"
+            fields=FILE_FIELDS
         ).execute()
         # print(response)
         return response
@@ -278,6 +1109,74 @@ def get_file(drive_service: Resource, file_id: str) -> dict:
         print(f'An error occurred: {e}')
         return None
 
+def get_files(drive_service: Resource, file_ids: list[str]) -> dict:
+    """
+    Returns the files with the given ids, using batch requests instead of a request per file.
+    Shortcuts are followed, so the file they point to is returned instead.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        file_ids (list[str]): The ids of the files
+
+    Returns:
+        dict: The File Resource of every file that could be found, by the id it was asked for
+
+    Raises:
+        Exception: If an error occured.
+    """
+    try:
+        files = batch_get_files(drive_service, set(file_ids))
+
+        shortcuts = {
+            file_id: file["shortcutDetails"]["targetId"]
+            for file_id, file in files.items()
+            if file.get("shortcutDetails", {}).get("targetId")
+        }
+        targets = batch_get_files(drive_service, set(shortcuts.values()))
+        for file_id, target_id in shortcuts.items():
+            if target_id in targets:
+                files[file_id] = targets[target_id]
+            else:
+                del files[file_id]
+
+        return files
+    except Exception as e:
+        print(f'An error occurred: {e}')
+        return None
+
+def batch_get_files(drive_service: Resource, file_ids: set[str]) -> dict:
+    """
+    Gets the files with the given ids in batches of BATCH_SIZE requests.
+
+    Args:
+        drive_service (Resource): The authenticated drive service instance
+        file_ids (set[str]): The ids of the files
+
+    Returns:
+        dict: The File Resource of every file that could be found, by its id
+    """
+    files = {}
+
+    def process_response(request_id, response, exception):
+        if exception is not None:
+            print(f"Request ID: {request_id} - Error: {exception}")
+        else:
+            files[request_id] = response
+
+    file_ids = list(file_ids)
+    for start in range(0, len(file_ids), BATCH_SIZE):
+        batch = drive_service.new_batch_http_request(callback=process_response)
+        for file_id in file_ids[start:start + BATCH_SIZE]:
+            request = drive_service.files().get(
+                fileId=file_id,
+                supportsAllDrives=True,
+                fields=FILE_FIELDS
+            )
+            batch.add(request, request_id=file_id)
+        batch.execute()
+
+    return files
+
 def get_credentials(path_to_creds: str, scopes: list[str], user: str = None) -> service_account.Credentials:
     """
     Gets the credentials instance from a service account.
@@ -295,6 +1194,7 @@ def get_credentials(path_to_creds: str, scopes: list[str], user: str = None) ->
     """
     print("Getting credentials")
     try:
+        from google.oauth2 import service_account
         credentials = service_account.Credentials.from_service_account_file(
             path_to_creds, 
             scopes=scopes
@@ -312,6 +1212,7 @@ def get_credentials(path_to_creds: str, scopes: list[str], user: str = None) ->
 def create_service(api_name: str, api_version: str, credentials: service_account.Credentials) -> Resource:
     """
     Initializes and returns a Google API service client.
+    The discovery document is only parsed on the first call, later calls build the service from the cached document.
 
     Args:
         api_name (str): The name of the API you want to interact with (e.g., 'sheets', 'drive').
@@ -328,13 +1229,71 @@ def create_service(api_name: str, api_version: str, credentials: service_account
         service = create_service('drive', 'v3', credentials)
     """
     try:
+        from googleapiclient.discovery import build, build_from_document
+        document = get_discovery_document(api_name, api_version)
+        if document is None:
+            # Not bundled with googleapiclient, so let build fetch it
+            return build(api_name, api_version, credentials=credentials)
+
         # Build the service
-        service = build(api_name, api_version, credentials=credentials)
+        service = build_from_document(document, credentials=credentials)
         return service
     except Exception as e:
         print(f'An error occurred: {e}')
         return None
 
+def get_discovery_document(api_name: str, api_version: str) -> dict:
+    """
+    Returns the parsed discovery document of an API from the documents bundled with googleapiclient.
+
+    Args:
+        api_name (str): The name of the API (e.g., 'drive').
+        api_version (str): The version of the API (e.g., 'v3').
+
+    Returns:
+        dict: The discovery document, or None if it isn't bundled
+    """
+    from googleapiclient import discovery_cache
+    from googleapiclient.discovery import build_from_document
+
+    key = (api_name, api_version)
+    with _discovery_lock:
+        if key not in _discovery_documents:
+            document = None
+            content = discovery_cache.get_static_doc(api_name, api_version)
+            if content is not None:
+                document = json.loads(content)
+                # Building a resource fills in defaults on the document the first time it is used.
+                # Doing that for every resource now keeps the shared document unchanged once other threads use it.
+                load_resources(build_from_document(document, http=httplib2.Http()), document)
+            _discovery_documents[key] = document
+        return _discovery_documents[key]
+
+def load_resources(resource: Resource, description: dict):
+    """
+    Creates every nested resource of a service, see get_discovery_document.
+
+    Args:
+        resource (Resource): The service or resource instance
+        description (dict): The part of the discovery document describing the resource
+    """
+    for name, nested_description in description.get("resources", {}).items():
+        load_resources(getattr(resource, name)(), nested_description)
+
+def is_enabled(value) -> bool:
+    """
+    Returns whether a setting is turned on, settings from the query string or environment are strings like "true".
+
+    Args:
+        value: The value of the setting
+
+    Returns:
+        bool: True if the setting is turned on
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
 def get_id_from_url(url: str) -> str:
     """
     Returns the ID for the Google File or Folder from the given URL.